@@ -14,7 +14,8 @@ Object-hash redis mapping library
 
 __all__ = ('Model', 'BaseModel', 'Field', 'String', 'Manager', 'Field', 'String', 'HashTable',
            'Link', 'Set', 'List', 'Composite', 'FK', 'StringPK', 'PrimaryKey', 'Integer',
-           'DateTime', 'NotFoundError', 'ValidationError', 'ImplementationError', 'get_version')
+           'DateTime', 'Counter', 'Float', 'Decimal', 'Bytes', 'JSON', 'NotFoundError', 'ValidationError', 'ImplementationError', 'get_version',
+           'configure', 'get_connection')
 
 
 __version__ = "0.1"
@@ -33,6 +34,7 @@ def get_version():
 from .models import Model, BaseModel
 from .exceptions import NotFoundError, ValidationError, ImplementationError
 from .fields import (Field, String, HashTable,  Link,  Set,  List,  Composite, FK,
-                    StringPK,  PrimaryKey,  Integer,  DateTime)
+                    StringPK,  PrimaryKey,  Integer,  DateTime, Counter, Float, Decimal, Bytes, JSON)
 from .manager import Manager
+from .connections import configure, get_connection
 
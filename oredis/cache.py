@@ -0,0 +1,160 @@
+# -*- coding:  utf-8 -*-
+"""
+oredis.cache
+~~~~~~~~~~~~
+
+Local cache of model instances
+
+:copyright: (c) 2011 by Alexandr Lispython (alex@obout.ru).
+:license: BSD, see LICENSE for more details.
+"""
+
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from redis.exceptions import ConnectionError
+from oredis.connections import get_connection
+
+
+# pub/sub channel of invalidation messages "<origin> <key>"
+CHANNEL = 'oredis:invalidate'
+
+# identifies messages published by this process
+ORIGIN = uuid.uuid4().hex
+
+# caches of models with cross-process invalidation keyed by model prefix
+_shared = {}
+
+
+class ObjectCache(object):
+    """Thread-safe LRU cache with optional time to live of entries
+    """
+    def __init__(self, size=1000, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # changed by every removal, see `set`
+        self.version = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None or (item[0] is not None and item[0] < time.time()):
+                self.misses += 1
+                return None
+            # reinsert to mark entry as recently used
+            self._items[key] = item
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value, version=None):
+        """Store `value`, unless `version` read before loading it differs
+        from current one, then entry could be removed while value was
+        loaded and value may be stale
+        """
+        expires = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+            self._items.pop(key, None)
+            self._items[key] = (expires, value)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self.version += 1
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.version += 1
+            self._items.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._items),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+            }
+
+
+def register(prefix, cache):
+    """Evict entries of `cache` on messages about keys of model `prefix`
+    """
+    _shared[prefix] = cache
+
+
+def message(key):
+    return '%s %s' % (ORIGIN, key)
+
+
+def handle_message(data):
+    """Evict key named in invalidation message from cache of its model
+    """
+    origin, key = data.split(' ', 1)
+    if origin == ORIGIN:
+        return
+    cache = _shared.get(key.split(':', 1)[0])
+    if cache is not None:
+        cache.delete(key)
+
+
+class InvalidationListener(threading.Thread):
+    """Background thread that evicts instances changed by other processes.
+
+    If subscription is lost all shared caches are cleared, because
+    messages published meanwhile are missed.
+    """
+    daemon = True
+
+    def __init__(self, connection, timeout=1, retry=1):
+        super(InvalidationListener, self).__init__(name='oredis-invalidation')
+        self.connection = connection
+        self.timeout = timeout
+        self.retry = retry
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self.listen()
+            except ConnectionError:
+                for cache in _shared.values():
+                    cache.clear()
+                self._stopped.wait(self.retry)
+
+    def listen(self):
+        pubsub = self.connection.pubsub()
+        pubsub.subscribe(CHANNEL)
+        try:
+            while not self._stopped.is_set():
+                msg = pubsub.get_message(timeout=self.timeout)
+                if msg and msg['type'] == 'message':
+                    handle_message(msg['data'])
+                elif msg is None:
+                    # avoid busy loop with clients that do not block
+                    self._stopped.wait(0.01)
+        finally:
+            pubsub.close()
+
+
+def start_listener(connection=None):
+    """Start listener thread on `connection` or default shared connection
+    """
+    listener = InvalidationListener(connection or get_connection())
+    listener.start()
+    return listener
@@ -0,0 +1,103 @@
+# -*- coding:  utf-8 -*-
+"""
+oredis.connections
+~~~~~~~~~~~~~~~~~~
+
+Registry of redis connections shared by all managers
+
+:copyright: (c) 2011 by Alexandr Lispython (alex@obout.ru).
+:license: BSD, see LICENSE for more details.
+"""
+
+import threading
+from redis import Redis, BlockingConnectionPool
+from oredis.exceptions import ImplementationError
+from oredis.utils import make_decoder
+
+
+DEFAULT_ALIAS = 'default'
+
+# size of connection pool per alias if not configured
+MAX_CONNECTIONS = 50
+
+# seconds to wait for free connection when pool is exhausted
+POOL_TIMEOUT = 20
+
+_lock = threading.Lock()
+_settings = {}
+_connections = {}
+_decoders = {}
+
+
+def configure(**aliases):
+    """Configure named connections.
+
+    Every value may be ready client instance, redis URL or dict of
+    connection arguments, which may also contain `max_connections` and
+    `timeout` of blocking connection pool and `detect_encoding` to guess
+    encoding of strings that can not be decoded with `encoding`::
+
+        configure(default={'host': 'localhost', 'max_connections': 20},
+                  cache='redis://cache:6379/1')
+
+    With `decode_responses` client returns unicode strings and fields skip
+    decoding, but such connection can not be used by `Bytes` fields and
+    fields with compression.
+    """
+    with _lock:
+        for alias, config in aliases.items():
+            _settings[alias] = config
+            _connections.pop(alias, None)
+            _decoders.pop(alias, None)
+
+
+def get_connection(alias=DEFAULT_ALIAS):
+    """Return client for `alias`, creating it on first use.
+
+    Clients of the same alias share one bounded thread-safe pool.
+    """
+    connection = _connections.get(alias)
+    if connection is None:
+        with _lock:
+            connection = _connections.get(alias)
+            if connection is None:
+                if alias not in _settings and alias != DEFAULT_ALIAS:
+                    raise ImplementationError('connection %s is not configured' % alias)
+                connection = _connections[alias] = create_connection(_settings.get(alias, {}))
+    return connection
+
+
+def get_decoder(alias=DEFAULT_ALIAS):
+    """Return function that decodes strings read with connection `alias`
+    """
+    decoder = _decoders.get(alias)
+    if decoder is None:
+        decoder = _decoders[alias] = connection_decoder(_settings.get(alias, {}))
+    return decoder
+
+
+def connection_decoder(config):
+    if hasattr(config, 'pipeline'):
+        config = config.connection_pool.connection_kwargs
+    elif isinstance(config, basestring):
+        config = {}
+    return make_decoder(config.get('encoding', 'utf-8'), config.get('encoding_errors', 'strict'),
+                        config.get('detect_encoding', False))
+
+
+def create_connection(config):
+    if hasattr(config, 'pipeline'):
+        return config
+    if isinstance(config, basestring):
+        config = {'url': config}
+    config = dict(config)
+    max_connections = config.pop('max_connections', MAX_CONNECTIONS)
+    timeout = config.pop('timeout', POOL_TIMEOUT)
+    config.pop('detect_encoding', None)
+    url = config.pop('url', None)
+    if url:
+        pool = BlockingConnectionPool.from_url(url, max_connections=max_connections,
+                                               timeout=timeout, **config)
+    else:
+        pool = BlockingConnectionPool(max_connections=max_connections, timeout=timeout, **config)
+    return Redis(connection_pool=pool)
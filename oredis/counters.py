@@ -0,0 +1,124 @@
+# -*- coding:  utf-8 -*-
+"""
+oredis.counters
+~~~~~~~~~~~~~~~
+
+Client-side accumulation of counter increments
+
+Increments of buffered `Counter` fields are summed locally per key and
+sent in one pipeline when `interval` seconds passed since last flush,
+when `size` keys are pending, when flusher thread wakes up or together
+with next pipeline or script of the same model.
+
+:copyright: (c) 2011 by Alexandr Lispython (alex@obout.ru).
+:license: BSD, see LICENSE for more details.
+"""
+
+import time
+import threading
+from redis.exceptions import ConnectionError
+
+
+class Accumulator(object):
+    def __init__(self, interval=1.0, size=1000):
+        self.interval = interval
+        self.size = size
+        self._pending = {}
+        self._flushed = time.time()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, model, cmd, amount):
+        """Add `amount` to pending increment command `cmd` of `model`,
+        command is given without amount. Increment is kept when flush
+        fails, so failed flush is not reported to caller.
+        """
+        self._add(model, cmd, amount)
+        if len(self._pending) >= self.size or time.time() - self._flushed >= self.interval:
+            try:
+                self.flush()
+            except ConnectionError:
+                pass
+
+    def _add(self, model, cmd, amount):
+        with self._lock:
+            entry = self._pending.get(cmd)
+            if entry is None:
+                entry = self._pending[cmd] = [model, 0]
+            entry[1] += amount
+
+    def take(self, model=None):
+        """Remove pending increments of `model`, or of all models, and
+        return their commands
+        """
+        if not self._pending:
+            return []
+        cmds = []
+        with self._lock:
+            for cmd, (owner, amount) in self._pending.items():
+                if model is None or owner is model:
+                    del self._pending[cmd]
+                    if amount:
+                        cmds.append((owner, cmd + (amount, )))
+        return cmds if model is None else [cmd for owner, cmd in cmds]
+
+    def restore(self, model, cmds):
+        """Return taken increment commands of `model` which were not sent
+        """
+        for cmd in cmds:
+            self._add(model, cmd[:-1], cmd[-1])
+
+    def flush(self):
+        """Send all pending increments, one pipeline per model. Increments
+        of models which were not sent are kept and the last error is
+        raised after all models were tried.
+        """
+        self._flushed = time.time()
+        models = {}
+        for model, cmd in self.take():
+            models.setdefault(model, []).append(cmd)
+        error = None
+        for model, cmds in models.items():
+            try:
+                model._managers['objects'].execute_pipeline(None, cmds)
+            except ConnectionError as e:
+                # keep increments to send them with next flush
+                self.restore(model, cmds)
+                error = e
+        if error is not None:
+            raise error
+
+
+# accumulator used by buffered counters
+buffer = Accumulator()
+
+
+class Flusher(threading.Thread):
+    """Background thread that flushes accumulator every `interval` seconds
+    """
+    daemon = True
+
+    def __init__(self, accumulator, interval=1.0):
+        super(Flusher, self).__init__(name='oredis-counters')
+        self.accumulator = accumulator
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.accumulator.flush()
+            except ConnectionError:
+                pass
+        self.accumulator.flush()
+
+
+def start_flusher(interval=1.0, accumulator=None):
+    flusher = Flusher(accumulator or buffer, interval)
+    flusher.start()
+    return flusher
@@ -12,11 +12,19 @@ Fields for redis models
 
 import copy
 import uuid
+import decimal
+import operator
+import threading
 from utils import timer
 from datetime import datetime
 from types import IntType, NoneType
-from oredis.exceptions import ValidationError
-from oredis.utils import super_force_unicode as sfu
+from redis.exceptions import ResponseError
+from oredis.exceptions import ValidationError, ImplementationError
+from oredis.scripts import get_script
+from oredis.serializers import get_serializer
+from oredis.query import TEMP_TTL
+from oredis import counters
+from oredis.utils import force_unicode
 
 
 def import_attr(module, name=None):
@@ -35,9 +43,17 @@ def import_attr(module, name=None):
 
 
 class Field(object):
-    def __init__(self, required=False, default=None, **kwargs):
+    scalar = True
+    sortable = False
+    serializer = None
+
+    def __init__(self, required=False, default=None, index=False, sorted_index=False,
+                 serializer=None, compress=None, compression='zlib', **kwargs):
         self.required = required
         self.default = default
+        self.index = index
+        self.sorted_index = sorted_index
+        self.serializer = get_serializer(serializer or self.serializer, compress, compression)
 
         self._name = None
         self._model = None
@@ -54,17 +70,25 @@ class Field(object):
 
     def __get__(self, instance, owner=None):
         assert self._name, 'field is not initialized'
-        if not instance:
+        if instance is None:
             return self
         field_data = instance.get_field(self._name)
-        field_data= self.to_python(field_data) if field_data else None
-        return field_data
+        return self.to_python(field_data) if field_data is not None else None
 
     def __set__(self, instance, value):
         assert self._name, 'field is not initialized'
         instance.set_field(self._name, self.from_python(value))
+        # assigned value is not replaced by stored one on access
+        instance.set_fetched(self._name)
+        instance.set_dirty(self._name)
 
     def contribute_to_class(self, model, name):
+        if self.index and not self.scalar:
+            raise ImplementationError('%s field %s can not be indexed' % (self.get_internal_type(), name))
+        if self.sorted_index and not (self.scalar and self.sortable):
+            raise ImplementationError('%s field %s can not be sorted' % (self.get_internal_type(), name))
+        if self.serializer is not None and (self.index or self.sorted_index or not self.scalar):
+            raise ImplementationError('%s field %s with serializer can not be indexed' % (self.get_internal_type(), name))
         self._model = model
         self._name = name
         setattr(model, name, self)
@@ -90,41 +114,141 @@ class Field(object):
         self.validate(value)
         return value
 
+    @property
+    def hashed(self):
+        return self.scalar and self._model._meta.storage == 'hash'
+
     def key(self, instance = None):
         return self._model.key(str(instance.id), self._name)
 
+    def hash_key(self, instance):
+        return self._model.key(str(instance.id))
+
+    def index_key(self, value):
+        return self._model.key('idx', self._name, force_unicode(self.to_db(value)))
+
+    def sorted_key(self):
+        return self._model.key('zidx', self._name)
+
+    def to_db(self, value):
+        """Convert value to form that is sent to redis
+        """
+        return value
+
+    def to_score(self, value):
+        return float(self.to_db(value))
+
+    def encode(self, value):
+        """Convert value to data stored in redis with serializer of field
+        """
+        value = self.to_db(value)
+        if self.serializer is None or value is None:
+            return value
+        return self.serializer.dumps(value)
+
+    def decode(self, data):
+        """Convert data returned by redis, inverse of `encode`
+        """
+        if self.serializer is None or data is None:
+            return data
+        return self.serializer.loads(data)
+
+    def copy_value(self, value):
+        """Copy of local value that shares no mutable state with it
+        """
+        return value if self.serializer is None else copy.deepcopy(value)
+
     def delete(self, instance):
-        cmd = self.deletecmd(instance)
-        if not cmd:
-            return
-        self.execute_cmd(instance, cmd)
+        for cmd in self.deletecmds(instance):
+            self.execute_cmd(instance, cmd)
 
     def load(self, instance):
+        if self.hashed:
+            return self.load_hash(instance)
         cmd = self.loadcmd(instance)
         if not cmd:
             return
-        return instance.set_field(self._name, self.execute_cmd(instance, cmd))
+        instance.set_fetched(self._name)
+        return instance.set_field(self._name, self.decode(self.execute_cmd(instance, cmd)))
+
+    def load_hash(self, instance):
+        """Load all hashed fields of instance with one HGETALL
+        """
+        values = self.execute_cmd(instance, ('hgetall', self.hash_key(instance)))
+        for name, field in instance._fields.items():
+            if field.hashed and not instance.is_fetched(name) and not instance._data.get(name):
+                instance.set_fetched(name)
+                instance.set_field(name, field.decode(values.get(name)))
+        return instance._data.get(self._name)
 
     def save(self, instance):
-        cmd = self.savecmd(instance)
-        if not cmd:
-            return
-        if cmd[2] is  None or cmd[2] == '' or cmd[2] == u'' or cmd[2] == "None" or cmd[2] == u"None":
-            return
-        self.execute_cmd(instance, cmd)
+        for cmd in self.savecmds(instance):
+            self.execute_cmd(instance, cmd)
 
     @timer
     def execute_cmd(self, instance, cmd):
         return getattr(self.redis, cmd[0])(*cmd[1:])
 
+    @timer
+    def execute_script(self, instance, cmd):
+        """Run script registered as cmd[0] with key cmd[1] and arguments
+        """
+        return get_script(cmd[0])(self.redis, cmd[1:2], cmd[2:])
+
+    def savecmds(self, instance):
+        """Commands that must be sent to store field value
+        """
+        cmd = self.savecmd(instance)
+        if not cmd:
+            return []
+        if cmd[-1] is None or cmd[-1] == '':
+            return []
+        return [cmd]
+
+    def deletecmds(self, instance):
+        """Commands that must be sent to remove field value
+        """
+        cmd = self.deletecmd(instance)
+        return [cmd] if cmd else []
+
     def deletecmd(self, instance):
+        if self.hashed:
+            return ('hdel', self.hash_key(instance), self._name)
         return ('delete', self.key(instance))
 
     def loadcmd(self, instance):
+        if self.hashed:
+            return 'hget', self.hash_key(instance), self._name
         return 'get', self.key(instance)
 
+    def indexcmds(self, instance, delete=False):
+        """Commands of `apply` script that move instance from index of
+        value stored in redis to index of current value or, if `delete`
+        is True, only remove it from index
+        """
+        value = ''
+        if not delete:
+            value = self.to_db(instance._data.get(self._name))
+            if value is None or value == '':
+                return []
+        mode = 'del' if delete else 'set'
+        return [('reindex', mode, self.index_key(''), instance.id, force_unicode(value)) +
+                tuple(self.loadcmd(instance))]
+
+    def sortcmds(self, instance):
+        value = self.to_db(instance._data.get(self._name))
+        if value is None or value == '':
+            return []
+        return [('zadd', self.sorted_key(), instance.id, self.to_score(value))]
+
+    def unsortcmds(self, instance):
+        return [('zrem', self.sorted_key(), instance.id)]
+
     def savecmd(self, instance):
-        return ('set', self.key(instance), instance._data[self._name])
+        value = self.encode(instance._data[self._name])
+        if self.hashed:
+            return ('hset', self.hash_key(instance), self._name, value)
+        return ('set', self.key(instance), value)
 
     def default(self):
         return None
@@ -135,18 +259,20 @@ class Field(object):
 
 class String(Field):
     def to_python(self, value):
-        super(String, self).to_python(value)
-        return sfu(value)
+        if value.__class__ is unicode:
+            return value
+        return self._model._managers['objects'].decoder(value)
 
     def from_python(self, value):
-        super(String, self).to_python(value)
-        return sfu(value)
+        return self.to_python(value) if value is not None else None
 
     def get_internal_type(self):
         return "String"
 
 
 class Integer(Field):
+    sortable = True
+
     def validate(self, value):
         super(Integer, self).validate(value)
         if not isinstance(value, IntType) and not isinstance(value, NoneType):
@@ -166,8 +292,199 @@ class Integer(Field):
         except ValueError:
             raise ValidationError('field %s requires integer value' % self.pyname)
 
+def value_operator(op, reflected=False):
+    """Return method applying `op` to value of bound counter
+    """
+    if reflected:
+        return lambda self, other: op(other, self.value)
+    return lambda self, other: op(self.value, other)
+
+
+class Counter(Integer):
+    """Integer changed on server with INCRBY (HINCRBY for hash storage).
+
+    Value is changed only with `incr` and `decr`, saving instance does
+    not overwrite it. With `buffered` increments are summed locally by
+    `oredis.counters.buffer` and sent later, value of instance is then
+    only estimated. Bound counter compares and computes as its value.
+    """
+    sortable = False
+    instance = None
+
+    def __init__(self, buffered=False, *args, **kwargs):
+        super(Counter, self).__init__(*args, **kwargs)
+        self.buffered = buffered
+
+    def contribute_to_class(self, model, name):
+        if self.index:
+            raise ImplementationError('Counter field %s can not be indexed' % name)
+        super(Counter, self).contribute_to_class(model, name)
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        return bind(self, instance)
+
+    def __set__(self, instance, value):
+        raise AttributeError('use incr/decr to change counters')
+
+    def validate(self, value):
+        return True
+
+    @property
+    def value(self):
+        return int(self.instance.get_field(self._name) or 0)
+
+    def __int__(self):
+        return self.value
+
+    __index__ = __long__ = __int__
+
+    def __float__(self):
+        return float(self.value)
+
+    def __cmp__(self, other):
+        if self.instance is None:
+            return cmp(id(self), id(other))
+        return cmp(self.value, int(other) if isinstance(other, Counter) else other)
+
+    def __eq__(self, other):
+        return self.__cmp__(other) == 0
+
+    def __ne__(self, other):
+        return self.__cmp__(other) != 0
+
+    def __hash__(self):
+        return id(self) if self.instance is None else hash(self.value)
+
+    def __nonzero__(self):
+        return self.instance is None or bool(self.value)
+
+    def __neg__(self):
+        return -self.value
+
+    __add__ = value_operator(operator.add)
+    __radd__ = value_operator(operator.add, True)
+    __sub__ = value_operator(operator.sub)
+    __rsub__ = value_operator(operator.sub, True)
+    __mul__ = value_operator(operator.mul)
+    __rmul__ = value_operator(operator.mul, True)
+    __div__ = value_operator(operator.div)
+    __rdiv__ = value_operator(operator.div, True)
+    __truediv__ = value_operator(operator.truediv)
+    __rtruediv__ = value_operator(operator.truediv, True)
+    __floordiv__ = value_operator(operator.floordiv)
+    __rfloordiv__ = value_operator(operator.floordiv, True)
+    __mod__ = value_operator(operator.mod)
+    __rmod__ = value_operator(operator.mod, True)
+
+    def __str__(self):
+        return str(self.value)
+
+    def __repr__(self):
+        return u'<%s: %s>' % (self.__class__.__name__, str(self._name))
+
+    def savecmd(self, instance):
+        return
+
+    def incrcmd(self, instance, amount):
+        if self.hashed:
+            return ('hincrby', self.hash_key(instance), self._name, amount)
+        return ('incrby', self.key(instance), amount)
+
+    def incr(self, amount=1):
+        """Add `amount` to counter and return its new value
+        """
+        if self.buffered:
+            value = self.value + amount
+            counters.buffer.add(self._model, self.incrcmd(self.instance, amount)[:-1], amount)
+        else:
+            value = self.execute_cmd(self.instance, self.incrcmd(self.instance, amount))
+            self.instance.evict(True)
+        self.instance.set_fetched(self._name)
+        return self.instance.set_field(self._name, value)
+
+    def decr(self, amount=1):
+        return self.incr(-amount)
+
+    def get_internal_type(self):
+        return "Counter"
+
+
+class Float(Field):
+    sortable = True
+
+    def to_python(self, value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            raise ValidationError('field %s requires float value' % self.pyname)
+
+    def from_python(self, value):
+        value = super(Float, self).from_python(value)
+        return None if value is None else self.to_python(value)
+
+    def to_db(self, value):
+        return repr(float(value)) if value is not None else None
+
+    def get_internal_type(self):
+        return "Float"
+
+
+class Decimal(Field):
+    sortable = True
+
+    def to_python(self, value):
+        try:
+            return decimal.Decimal(value)
+        except (TypeError, ValueError, decimal.InvalidOperation):
+            raise ValidationError('field %s requires decimal value' % self.pyname)
+
+    def from_python(self, value):
+        value = super(Decimal, self).from_python(value)
+        return None if value is None else self.to_python(value)
+
+    def to_db(self, value):
+        return str(value) if value is not None else None
+
+    def get_internal_type(self):
+        return "Decimal"
+
+
+class Bytes(Field):
+    """Byte string stored and returned without unicode coercion
+    """
+    def to_python(self, value):
+        return value.encode('utf-8') if isinstance(value, unicode) else value
+
+    def from_python(self, value):
+        value = super(Bytes, self).from_python(value)
+        if not isinstance(value, (basestring, NoneType)):
+            raise ValidationError('field %s requires byte string value' % self.pyname)
+        return self.to_python(value)
+
+    def to_db(self, value):
+        return self.to_python(value)
+
+    def get_internal_type(self):
+        return "Bytes"
+
+
+class JSON(Field):
+    """Structured value stored with JSON or other `serializer`
+    """
+    serializer = 'json'
+
+    def get_internal_type(self):
+        return "JSON"
+
+
 class DateTime(Field):
+    sortable = True
+
     def to_python(self, value):
+        if isinstance(value, datetime):
+            return value
         return datetime.fromtimestamp(float(value))
 
     def from_python(self, value):
@@ -176,10 +493,26 @@ class DateTime(Field):
             raise ValidationError('field %s requires datetime value' % self.pyname)
         return value.strftime('%s')
 
+    def to_db(self, value):
+        if isinstance(value, datetime):
+            return value.strftime('%s')
+        return value
+
 
 class PrimaryKey(Integer):
-    def __init__(self, *args, **kwargs):
+    """Integer id from counter `model` key.
+
+    With `batch` > 1 ids are reserved in blocks with one INCRBY and handed
+    out locally, ids of unused part of block are skipped on restart.
+    """
+    scalar = False
+
+    def __init__(self, batch=1, *args, **kwargs):
         super(PrimaryKey, self).__init__(required=True, *args, **kwargs)
+        self.batch = batch
+        self._next = 1
+        self._last = 0
+        self._lock = threading.Lock()
 
     def __get__(self, instance, owned = None):
         if not instance:
@@ -193,7 +526,22 @@ class PrimaryKey(Integer):
         return self._model.key('all')
 
     def next(self, instance):
-        return self.execute_cmd(instance, ('incr', self._model.key()))
+        if self.batch <= 1:
+            return self.execute_cmd(instance, ('incr', self._model.key()))
+        with self._lock:
+            if self._next > self._last:
+                self._last = self.execute_cmd(instance, ('incrby', self._model.key(), self.batch))
+                self._next = self._last - self.batch + 1
+            self._next += 1
+            return self._next - 1
+
+    def reserve(self, count):
+        """Allocate `count` new ids with one INCRBY
+        """
+        if not count:
+            return []
+        last = self.execute_cmd(None, ('incrby', self._model.key(), count))
+        return range(last - count + 1, last + 1)
 
     def savecmd(self, instance):
         return 'sadd', self.key(), self.from_python(self.__get__(instance))
@@ -208,6 +556,8 @@ class PrimaryKey(Integer):
         return "PrimaryKey"
 
 class StringPK(String):
+    scalar = False
+
     def __init__(self, *args, **kwargs):
         super(StringPK, self).__init__(required=True, *args, **kwargs)
 
@@ -222,6 +572,9 @@ class StringPK(String):
     def next(self, instance):
         return uuid.uuid4().hex
 
+    def reserve(self, count):
+        return [uuid.uuid4().hex for i in xrange(count)]
+
     def savecmd(self, instance):
         return 'sadd', self.key(), self.from_python(self.__get__(instance))
 
@@ -256,7 +609,8 @@ class FK(Field):
     def validate(self, value):
         from models import Model
         super(FK, self).validate(value)
-        if not isinstance(value, Model) and not isinstance(value, NoneType):
+        # loaded and assigned values are kept as ids
+        if not isinstance(value, (Model, NoneType, basestring, int, long)):
             raise ValidationError('field %s is required field instance value' % self.pyname)
         return True
     def from_python(self, value):
@@ -268,6 +622,9 @@ class FK(Field):
     def to_python(self, value):
         return value
 
+    def to_db(self, value):
+        return getattr(value, 'id', value)
+
     def contribute_to_class(self, model, name):
         super(FK, self).contribute_to_class(model, name)
         self._model = model
@@ -277,11 +634,59 @@ class FK(Field):
     def get_internal_type(self):
         return "FK"
 
+def field_attribute(name):
+    return property(lambda self: getattr(self._field, name))
+
+
+def bound_class(field):
+    """Return subclass of class of `field` whose instances bind field to
+    model instance. Bound objects keep references to field and instance in
+    slots and read other attributes from field; field classes have no
+    slots, so `__dict__` of bound object stays empty but is not removed.
+    """
+    bound = field.__dict__.get('_bound_class')
+    if bound is None:
+        def __init__(self, field, instance):
+            self._field = field
+            self._name = field._name
+            self._model = field._model
+            self.instance = instance
+
+        def __getattr__(self, name):
+            return getattr(self._field, name)
+
+        slots = ('_field', '_name', '_model', 'instance')
+        # attributes of field would be shadowed by class attributes of the
+        # same name, like `default` method, so they are read with properties
+        attrs = dict((name, field_attribute(name)) for name in field.__dict__ if name not in slots)
+        attrs.update({'__slots__': slots, '__init__': __init__, '__getattr__': __getattr__})
+        bound = field._bound_class = type('Bound%s' % field.__class__.__name__, (field.__class__, ), attrs)
+    return bound
+
+
+def bind(field, instance):
+    """Bound object of `field`, created once per model `instance`
+    """
+    if instance._bound is None:
+        instance._bound = {}
+    bound = instance._bound.get(field._name)
+    if bound is None:
+        bound = instance._bound[field._name] = bound_class(field)(field, instance)
+    return bound
+
+
 class Composite(Field):
+    scalar = False
+    container = list
+    instance = None
+    # items fetched per round trip by `iter_chunks`
+    batch_size = 500
+
     def __get__(self, instance, owner=None):
-        new = copy.copy(self)
-        new.instance = instance
-        return new
+        if instance is None:
+            return self
+        # bound collection is created once per model instance
+        return bind(self, instance)
 
     def __set__(self, instance, value):
         raise AttributeError('use append/prepend to change %ss' % self.__class__.__name__.lower())
@@ -292,10 +697,61 @@ class Composite(Field):
     def savecmd(self, instance):
         return
 
+    def copy_value(self, value):
+        return copy.copy(value)
+
     @property
     def value(self):
         assert self.instance, '%s is not initialized' % self.pyname
-        return super(Composite, self).__get__(self.instance)
+        if not self.instance.is_fetched(self._name):
+            self.load(self.instance)
+        value = super(Composite, self).__get__(self.instance)
+        return self.container() if value is None else value
+
+    def cached(self):
+        """Locally cached raw value or None if collection is not loaded.
+
+        Mutators update cached value from replies of commands instead of
+        loading whole collection again.
+        """
+        if not self.instance.is_fetched(self._name):
+            return None
+        value = self.instance._data.get(self._name)
+        if value is None:
+            value = self.instance.set_field(self._name, self.container())
+        return value
+
+    def _mutated(self):
+        self.instance.evict(True)
+        return self.cached()
+
+    def invalidate(self):
+        """Drop cached value, it will be loaded on next access
+        """
+        self.instance.set_fetched(self._name, False)
+        self.instance.set_field(self._name, None)
+
+    def refresh(self):
+        """Load whole collection from redis
+        """
+        self.load(self.instance)
+        return self
+
+    def scan(self, batch_size=None, **kwargs):
+        """Iterate over items of collection without loading it whole.
+        Collections define `iter_chunks`, which generates parts of about
+        `batch_size` items, one part per round trip.
+        """
+        for chunk in self.iter_chunks(batch_size, **kwargs):
+            for item in chunk:
+                yield item
+
+    def raw(self, value):
+        """Value in form it is returned by redis
+        """
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return value if isinstance(value, str) else str(value)
 
     def get_internal_type(self):
         return "Composite"
@@ -312,10 +768,13 @@ class List(Composite):
 
     def to_python(self, value):
         value = super(List, self).to_python(value)
+        if self.handler is None:
+            return value
         return value and map(self.handler, value) or value
 
     def from_python(self, value):
-        return self.handler(super(List, self).from_python(value))
+        value = super(List, self).from_python(value)
+        return value if self.handler is None else self.handler(value)
     # list methods
 
     def __eq__(self, other):
@@ -331,52 +790,118 @@ class List(Composite):
         return self.value[index]
 
     def __setitem__(self, index, value):
-        self.value[index] = value
         self.lset(value, index)
 
     def __delitem__(self, index):
         if isinstance(index, slice): return False
-        uid = uuid.uuid4().hex
-        self.lset(uid, index)
-        self.lrem(self.value[index])
+        try:
+            value = self.execute_script(self.instance, ('ldelete', self.key(self.instance),
+                                                        int(index), uuid.uuid4().hex))
+        except ResponseError:
+            raise IndexError('list index out of range')
+        items = self._mutated()
+        if items is not None:
+            if -len(items) <= index < len(items) and items[index] == value:
+                del items[index]
+            else:
+                self.invalidate()
+
+    def _check(self, items, length):
+        if len(items) != length:
+            self.invalidate()
 
     def append(self,  value):
-        self.execute_cmd(self.instance, ('rpush', self.key(self.instance), self.from_python(value)))
-        self.load(self.instance)
+        value = self.from_python(value)
+        length = self.execute_cmd(self.instance, ('rpush', self.key(self.instance), value))
+        items = self._mutated()
+        if items is not None:
+            items.append(self.raw(value))
+            self._check(items, length)
 
     def prepend( self, value):
-        self.execute_cmd(self.instance, ('lpush', self.key(self.instance), self.from_python(value)))
-        self.load(self.instance)
+        value = self.from_python(value)
+        length = self.execute_cmd(self.instance, ('lpush', self.key(self.instance), value))
+        items = self._mutated()
+        if items is not None:
+            items.insert(0, self.raw(value))
+            self._check(items, length)
+
+    def _pop(self, cmd, index):
+        value = self.execute_cmd(self.instance, (cmd, self.key(self.instance)))
+        items = self._mutated()
+        if items is not None:
+            if items and items[index] == value:
+                items.pop(index)
+            elif value is not None:
+                self.invalidate()
+        return value
 
     def rpop(self):
-        return self.execute_cmd(self.instance, ('rpop', self.key(self.instance)))
+        return self._pop('rpop', -1)
 
     def lpop(self):
-        return self.execute_cmd(self.instance, ('lpop', self.key(self.instance)))
+        return self._pop('lpop', 0)
 
     def lset(self, value, position):
-        self.execute_cmd(self.instance, ('lset', self.key(self.instance), int(position), self.from_python(value)))
-        self.load(self.instance)
+        value = self.from_python(value)
+        self.execute_cmd(self.instance, ('lset', self.key(self.instance), int(position), value))
+        items = self._mutated()
+        if items is not None:
+            try:
+                items[int(position)] = self.raw(value)
+            except IndexError:
+                self.invalidate()
 
     def lrem( self, value, count = 0):
-        self.execute_cmd(self.instance, ('lrem', self.key(self.instance), self.from_python(value), int(count), ))
-        self.load(self.instance)
+        value = self.from_python(value)
+        removed = self.execute_cmd(self.instance, ('lrem', self.key(self.instance), value, int(count), ))
+        items = self._mutated()
+        if items is not None:
+            raw = self.raw(value)
+            indexes = [i for i, x in enumerate(items) if x == raw]
+            if count < 0:
+                indexes.reverse()
+            if count:
+                indexes = indexes[:abs(count)]
+            for i in sorted(indexes, reverse=True):
+                del items[i]
+            if len(indexes) != removed:
+                self.invalidate()
+        return removed
 
     def lindex(self, index):
         return self.execute_cmd(self.instance, ('lindex', self.key(self.instance), int(index)))
 
     def trim(self, start=0, end=-1):
-        self.execute_cmd(self.instance, ('ltrim', start, end))
-        self.load(self.instance)
+        self.execute_cmd(self.instance, ('ltrim', self.key(self.instance), start, end))
+        items = self._mutated()
+        if items is not None:
+            items[:] = items[start:None if end == -1 else end + 1]
 
     def lrange(self, start = 0, end =- 1):
         return self.to_python(self.execute_cmd(self.instance, ('lrange', self.key(self.instance), start, end)))
 
+    def iter_chunks(self, batch_size=None):
+        """Windowed LRANGE, items inserted or removed during iteration
+        shift windows
+        """
+        batch_size = batch_size or self.batch_size
+        start = 0
+        while True:
+            items = self.lrange(start, start + batch_size - 1)
+            if items:
+                yield items
+            if len(items) < batch_size:
+                return
+            start += batch_size
+
     def get_internal_type(self):
         return "List"
 
 
 class Set(Composite):
+    container = set
+
     def __init__(self, handler=unicode, *args, **kwargs):
         super(Set, self).__init__(*args, **kwargs)
         self.handler = handler
@@ -387,6 +912,8 @@ class Set(Composite):
 
     def to_python(self, value):
         value = super(Set, self).to_python(value)
+        if self.handler is None:
+            return value
         return value and set(map(self.handler, value)) or value
 
     def __eq__(self, other):
@@ -400,37 +927,137 @@ class Set(Composite):
 
     def pop(self):
         pop = self.execute_cmd(self.instance, ('spop', self.key(self.instance)))
-        self.load(self.instance)
-        return self.handler(pop)
+        items = self._mutated()
+        if items is not None:
+            items.discard(pop)
+        return pop if self.handler is None else self.handler(pop)
 
     def add(self, value):
         self.validate_value(value)
-        self.execute_cmd(self.instance, ('sadd', self.key(self.instance), self.from_python(value)))
-        self.load(self.instance)
+        value = self.from_python(value)
+        added = self.execute_cmd(self.instance, ('sadd', self.key(self.instance), value))
+        self._update(value, added, True)
+        return added
 
     def rem(self, value):
         self.validate_value(value)
-        self.execute_cmd(self.instance, ('srem', self.key(self.instance), self.from_python(value)))
-        self.load(self.instance)
+        value = self.from_python(value)
+        removed = self.execute_cmd(self.instance, ('srem', self.key(self.instance), value))
+        self._update(value, removed, False)
+        return removed
+
+    def _update(self, value, changed, added):
+        items = self._mutated()
+        if items is None:
+            return
+        raw = self.raw(value)
+        # reply differs from local state when set was changed elsewhere
+        if bool(changed) != ((raw not in items) if added else (raw in items)):
+            self.invalidate()
+        elif added:
+            items.add(raw)
+        else:
+            items.discard(raw)
 
     def validate_value(self, value):
         return True
 
-    def _interact(self, cmd, other):
-        return self.execute_cmd(self.instance, (cmd, (self.key(self.instance), other.key(other.instance))))
-
-    inter = lambda self, other: self._interact('sinter', other)
-    union = lambda self, other: self._interact('sunion', other)
-    diff = lambda self, other: self._interact('sdiff', other)
+    def iter_chunks(self, batch_size=None, key=None):
+        """SSCAN over set or over other set `key`, e.g. result of
+        `interstore`. Members changed during iteration may be returned
+        twice or skipped.
+        """
+        for items in self._sscan(batch_size, key):
+            yield self.to_python(items)
+
+    def _sscan(self, batch_size=None, key=None):
+        cursor = 0
+        while True:
+            cursor, items = self.execute_cmd(self.instance, ('sscan', key or self.key(self.instance), cursor,
+                                                             None, batch_size or self.batch_size))
+            if items:
+                yield items
+            if not int(cursor):
+                return
+
+    def _keys(self, others):
+        """Keys of this set and `others`, which are Set or Link fields of
+        instances or keys of sets, e.g. `Field.index_key(value)`
+        """
+        return [self.key(self.instance)] + [x if isinstance(x, basestring) else x.key(x.instance)
+                                            for x in others]
+
+    def _interact(self, cmd, others):
+        return self.execute_cmd(self.instance, (cmd, self._keys(others)))
+
+    def _store(self, cmd, others, ttl=TEMP_TTL):
+        """Store result of `cmd` in temporary key that expires in `ttl`
+        seconds and return the key
+        """
+        key = self._model.key('tmp', uuid.uuid4().hex)
+        self._model._managers['objects'].execute_pipeline(
+            self.instance, [(cmd, key, self._keys(others)), ('expire', key, ttl)], True)
+        return key
+
+    inter = lambda self, *others: self._interact('sinter', others)
+    union = lambda self, *others: self._interact('sunion', others)
+    diff = lambda self, *others: self._interact('sdiff', others)
+
+    interstore = lambda self, *others, **kwargs: self._store('sinterstore', others, **kwargs)
+    unionstore = lambda self, *others, **kwargs: self._store('sunionstore', others, **kwargs)
+    diffstore = lambda self, *others, **kwargs: self._store('sdiffstore', others, **kwargs)
+
+    # SINTERCARD needs redis 7.0, set to False after first refusal
+    sintercard = True
+
+    def intercard(self, *others, **kwargs):
+        """Size of intersection with `others`, counting stops at `limit`
+        if it is given
+        """
+        keys = self._keys(others)
+        limit = kwargs.get('limit', 0)
+        if Set.sintercard:
+            try:
+                return self.execute_cmd(self.instance, ('execute_command', 'SINTERCARD', len(keys)) +
+                                        tuple(keys) + ('LIMIT', limit))
+            except ResponseError, e:
+                if 'unknown command' not in str(e).lower():
+                    raise
+                Set.sintercard = False
+        key = self._model.key('tmp', uuid.uuid4().hex)
+        count = self._model._managers['objects'].execute_pipeline(
+            self.instance, [('sinterstore', key, keys), ('delete', key)], True)[0]
+        return min(count, limit) if limit else count
 
     def get_internal_type(self):
         return "Set"
 
 
+class Prefetched(set):
+    """Raw members of Link field with linked instances loaded in advance,
+    keyed by raw id
+    """
+    __slots__ = ('objects', )
+
+    def __init__(self, members=(), objects=None):
+        super(Prefetched, self).__init__(members)
+        self.objects = objects if objects is not None else {}
+
+    def __copy__(self):
+        return Prefetched(self, dict(self.objects))
+
+
 class Link(Set):
-    def __init__(self, to, related_name = None, *args, **kwargs):
+    """Set of linked instances of model `to`.
+
+    All linked instances are checked and loaded with one pipeline, with
+    `lazy` True instances without any fields are returned instead and
+    their fields are loaded on first access.
+    """
+    def __init__(self, to, related_name = None, lazy = False, *args, **kwargs):
         super(Link, self).__init__(*args, **kwargs)
         self.to = to
+        self.lazy = lazy
         self._related_name = related_name
         if not isinstance(to, basestring):
             self.handler = to.get
@@ -457,6 +1084,23 @@ class Link(Set):
 
         return True
 
+    def objects(self, ids):
+        """Load linked instances with `ids` in one round trip, missing
+        instances are skipped
+        """
+        return self.to.get_many(ids)
+
+    inter_objects = lambda self, *others: self.objects(self.inter(*others))
+    union_objects = lambda self, *others: self.objects(self.union(*others))
+    diff_objects = lambda self, *others: self.objects(self.diff(*others))
+
+    def iter_chunks(self, batch_size=None, key=None):
+        """Lists of linked instances, every list is loaded with one round
+        trip
+        """
+        for ids in self._sscan(batch_size, key):
+            yield self.objects(ids)
+
     def validate_value(self, value):
         super(Link, self).validate_value(value)
         if not isinstance(value, self.to):
@@ -471,8 +1115,29 @@ class Link(Set):
                                   self.pyname)
 
     def to_python(self, value):
-        value = super(Link, self).to_python(value)
-        return value
+        if not value:
+            return value
+        if getattr(value, 'objects', None) is None:
+            if self.instance is None or value is not self.instance._data.get(self._name):
+                return set(self.hydrate(value))
+            # linked instances are kept with cached members until the
+            # field is invalidated
+            value = self.instance.set_field(self._name, Prefetched(value))
+        objects = value.objects
+        # members added after loading are loaded now, missing instances
+        # are remembered as None
+        missing = [id for id in value if id not in objects]
+        if missing:
+            found = dict((self.raw(obj.id), obj) for obj in self.hydrate(missing))
+            objects.update((id, found.get(id)) for id in missing)
+        return set(objects[id] for id in value if objects[id] is not None)
+
+    def hydrate(self, ids):
+        """Linked instances with `ids`, stubs if field is `lazy`
+        """
+        if self.lazy:
+            return [self.to._from_id(id) for id in ids]
+        return self.objects(ids)
 
 
     def contribute_to_class(self, model, name):
@@ -486,15 +1151,8 @@ class Link(Set):
 
 
 
-class HashTable(Field):
-
-    def __get__(self, instance, owner=None):
-        new = copy.copy(self)
-        new.instance = instance
-        return new
-
-    def __post_init__(self,  instance, *args, **kwargs):
-        super(HashTable, self).__post_init__(instance, *args, **kwargs)
+class HashTable(Composite):
+    container = dict
 
     def __set__(self, instance, value):
         raise AttributeError('use object methods to change values for %s' %  self.__class__.__name__.lower())
@@ -517,39 +1175,46 @@ class HashTable(Field):
     def getall(self):
         return self.execute_cmd(self.instance,  ('hgetall',  self.key(self.instance)))
 
+    def iter_chunks(self, batch_size=None):
+        """HSCAN over hash, every chunk is dict
+        """
+        cursor = 0
+        while True:
+            cursor, items = self.execute_cmd(self.instance, ('hscan', self.key(self.instance), cursor,
+                                                             None, batch_size or self.batch_size))
+            if items:
+                yield items
+            if not int(cursor):
+                return
+
+    def scan(self, batch_size=None):
+        """Iterate over (key, value) pairs of hash
+        """
+        for chunk in self.iter_chunks(batch_size):
+            for item in chunk.iteritems():
+                yield item
+
     def exist(self,  key):
         return self.execute_cmd(self.instance,  ('hexists',  self.key(self.instance), key))
 
-    def savecmd(self, instance):
-        return
-
-    @property
-    def value(self):
-        assert self.instance, '%s is not initialized' % self.pyname
-        if not self.instance:
-            return self
-        return self.instance.get_field(self._name,  self.load)
-
-    def load(self, instance):
-        cmd = self.loadcmd(instance)
-        if not cmd:
-            return
-        self.instance = instance
-        return instance.set_field(self._name, self.getall())
-
     def __getitem__(self, index):
         return self.value[index]
-        return self.execute_cmd(self.instance,  ('hget',  self.key(self.instance),  index))
 
     def __setitem__(self, index,  value):
-        return self.execute_cmd(self.instance,  ('hset',  self.key(self.instance),  index,  value))
+        result = self.execute_cmd(self.instance,  ('hset',  self.key(self.instance),  index,  value))
+        items = self._mutated()
+        if items is not None:
+            items[self.raw(index)] = self.raw(value)
+        return result
 
     def __len__(self):
         return self.execute_cmd(self.instance,  ('hlen',  self.key(self.instance)))
 
     def __delitem__(self, index):
         self.execute_cmd(self.instance,  ('hdel',  self.key(self.instance), index))
-        self.load(self.instance)
+        items = self._mutated()
+        if items is not None:
+            items.pop(self.raw(index), None)
 
     def from_python(self, value):
         return value
@@ -0,0 +1,116 @@
+# -*- coding:  utf-8 -*-
+"""
+oredis.instrumentation
+~~~~~~~~~~~~~~~~~~~~~~
+
+Optional recording of redis commands sent by models.
+
+Instrumentation is disabled by default and costs one flag check per
+command. When enabled every (sampled) command is passed to hook, default
+hook keeps aggregated counters and bounded log of recent commands per
+model and per instance.
+
+:copyright: (c) 2011 by Alexandr Lispython (alex@obout.ru).
+:license: BSD, see LICENSE for more details.
+"""
+
+import random
+from collections import deque
+
+
+enabled = False
+sample_rate = 1.0
+log_size = 100
+hook = None
+
+
+def enable(size=100, rate=1.0, callback=None):
+    """Start recording commands.
+
+    size: number of recent commands kept per model and per instance
+    rate: fraction of commands that are recorded
+    callback: function called as callback(model, instance, name, key,
+              duration, size) instead of default recording
+    """
+    global enabled, sample_rate, log_size, hook
+    log_size = size
+    sample_rate = rate
+    hook = callback
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def sampled():
+    return enabled and (sample_rate >= 1 or random.random() < sample_rate)
+
+
+class QueryLog(object):
+    """Aggregated statistics and bounded log of recent commands
+    """
+    def __init__(self, size):
+        self.queries = deque(maxlen=size)
+        self.count = 0
+        self.total_time = 0.0
+        self.commands = {}
+
+    def record(self, name, key, duration, size):
+        self.queries.append((name, key, duration, size))
+        self.count += 1
+        self.total_time += duration
+        stats = self.commands.get(name)
+        if stats is None:
+            stats = self.commands[name] = [0, 0.0, 0]
+        stats[0] += 1
+        stats[1] += duration
+        stats[2] += size
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'total_time': self.total_time,
+            'queries': list(self.queries),
+            'commands': dict((name, {'count': x[0], 'total_time': x[1], 'size': x[2]})
+                             for name, x in self.commands.items())
+            }
+
+
+def get_log(model):
+    log = model.__dict__.get('_query_log')
+    if log is None:
+        log = QueryLog(log_size)
+        setattr(model, '_query_log', log)
+    return log
+
+
+def payload_size(args):
+    size = 0
+    for arg in args:
+        if isinstance(arg, basestring):
+            size += len(arg)
+        elif isinstance(arg, dict):
+            size += payload_size(arg.keys()) + payload_size(arg.values())
+        elif isinstance(arg, (list, tuple)):
+            size += payload_size(arg)
+        else:
+            size += 8
+    return size
+
+
+def record(model, instance, cmds, duration):
+    """Record commands sent in one round trip of `duration` seconds
+    """
+    duration = duration / (len(cmds) or 1)
+    for cmd in cmds:
+        key = cmd[1] if len(cmd) > 1 and isinstance(cmd[1], basestring) else None
+        size = payload_size(cmd[2:])
+        if hook is not None:
+            hook(model, instance, cmd[0], key, duration, size)
+            continue
+        if model is not None:
+            get_log(model).record(cmd[0], key, duration, size)
+        if instance is not None:
+            instance.update_queries((cmd[0], key, duration, size))
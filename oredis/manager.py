@@ -10,7 +10,14 @@ Manager class for redis models
 """
 
 
+from itertools import islice
 from redis import Redis
+from redis.exceptions import ConnectionError
+from oredis import scripts, counters
+from oredis.utils import pipeline_timer
+from oredis.exceptions import ImplementationError
+from oredis.query import QuerySet
+from oredis.connections import get_connection, get_decoder, connection_decoder, DEFAULT_ALIAS
 
 
 class ManagerDescriptor(object):
@@ -28,25 +35,193 @@ class Manager(object):
     """Functons for managing redis queries
     """
     _connection = None
-    def __init__(self, connection = None, *args, **kwargs):
+    _decoder = None
+    def __init__(self, connection = None, using = None, *args, **kwargs):
         self._model = None
         self._name = None
+        self._using = using
         self.db = None
         self.setup_connection(connection)
 
     def setup_connection(self, connection = None, *args, **kwargs):
+        """Use own `connection` or create one from arguments.
+        Without both shared connection from registry is used.
+        """
         if connection: self._connection = connection
-        else: self._connection = Redis(*args, **kwargs)
+        elif args or kwargs: self._connection = Redis(*args, **kwargs)
+        else: self._connection = None
+        self._decoder = None
         return self._connection
 
+    @property
+    def using(self):
+        if self._using:
+            return self._using
+        return self._model._meta.using if self._model else DEFAULT_ALIAS
+
     @property
     def connection(self):
-        return self._connection
+        if self._connection is not None:
+            return self._connection
+        return get_connection(self.using)
+
+    @property
+    def decoder(self):
+        """Function that decodes strings read with connection of manager
+        """
+        if self._connection is None:
+            return get_decoder(self.using)
+        if self._decoder is None:
+            self._decoder = connection_decoder(self._connection)
+        return self._decoder
+
+    def get_many(self, ids, fields=None):
+        return self._model.get_many(ids, fields)
+
+    def in_bulk(self, ids, fields=None):
+        """Return dict of loaded instances keyed by id
+        """
+        return dict((obj.id, obj) for obj in self._model.get_many(ids, fields))
+
+    def bulk_create(self, objs, chunk_size=500):
+        """Save new instances with one script call per `chunk_size` instances.
+
+        Missing ids are allocated with single INCRBY. Every chunk is
+        written atomically. Return list of saved instances.
+        """
+        objs = list(objs)
+        new = [obj for obj in objs if not obj._data.get('id')]
+        for obj, id in zip(new, self._model.id.reserve(len(new))):
+            obj.set_field('id', id)
+        for start in xrange(0, len(objs), chunk_size):
+            chunk = objs[start:start + chunk_size]
+            cmds = []
+            for obj in chunk:
+                obj.validate()
+                cmds.extend(obj.savecmds())
+            self.execute_script(None, cmds)
+            for obj in chunk:
+                obj._dirty = None
+                obj._loaded = True
+                obj.evict()
+        return objs
+
+    def bulk_delete(self, ids, chunk_size=500):
+        """Remove instances with given `ids` with one script call per
+        `chunk_size` instances.
+
+        Keys of all fields are removed with UNLINK, so memory of large
+        collections is freed in background. Return number of processed ids.
+        """
+        model = self._model
+        ids, count = iter(ids), 0
+        while True:
+            chunk = [model._from_id(id) for id in islice(ids, chunk_size)]
+            if not chunk:
+                return count
+            cmds = []
+            for obj in chunk:
+                cmds.extend(obj.deletecmds('unlink'))
+            self.execute_script(None, cmds)
+            for obj in chunk:
+                if model._cache is not None:
+                    model._cache.delete(obj.key(str(obj.id)))
+            count += len(chunk)
+
+    def all(self):
+        return QuerySet(self._model)
+
+    def filter(self, **kwargs):
+        """Return lazy queryset over indexes.
+
+        Equality lookups use index sets (`index=True`), range lookups
+        (`field__gt`, `__gte`, `__lt`, `__lte`) use sorted indexes
+        (`sorted_index=True`).
+        """
+        return QuerySet(self._model).filter(**kwargs)
+
+    def order_by(self, name):
+        return QuerySet(self._model).order_by(name)
+
+    def migrate_to_hash(self, batch_size=500):
+        """Move scalar fields stored in separate keys into instance hashes.
+
+        Model must be declared with `storage = 'hash'`. Every batch costs two
+        round trips: one to read old keys and one to write hashes and remove
+        old keys. Return number of migrated instances.
+        """
+        model = self._model
+        if model._meta.storage != 'hash':
+            raise ImplementationError('%s does not use hash storage' % model.__name__)
+        names = [name for name, field in model._fields.items() if field.hashed]
+        migrated, ids = 0, []
+        for id in self.connection.sscan_iter(model.id.key(), count=batch_size):
+            ids.append(id)
+            if len(ids) >= batch_size:
+                migrated += self._migrate_batch(ids, names)
+                ids = []
+        if ids:
+            migrated += self._migrate_batch(ids, names)
+        return migrated
+
+    def _migrate_batch(self, ids, names):
+        model = self._model
+        cmds = [('get', model.key(str(id), name)) for id in ids for name in names]
+        values = iter(self.execute_pipeline(None, cmds))
+        cmds = []
+        for id in ids:
+            mapping = {}
+            for name in names:
+                value = values.next()
+                if value is not None:
+                    mapping[name] = value
+            if mapping:
+                cmds.append(('hmset', model.key(str(id)), mapping))
+                cmds.append(('delete', ) + tuple(model.key(str(id), name) for name in mapping))
+        self.execute_pipeline(None, cmds, True)
+        return len(cmds) / 2
+
+    @pipeline_timer
+    def execute_pipeline(self, instance, cmds, transaction=False):
+        """Send all `cmds` in one round trip and return list of replies.
+
+        Wrap commands into MULTI/EXEC if `transaction` is True.
+        """
+        # buffered counter increments of model are sent with the pipeline
+        pending = self.take_increments()
+        if not cmds and not pending:
+            return []
+        pipe = self.connection.pipeline(transaction=transaction)
+        for cmd in pending + list(cmds):
+            getattr(pipe, cmd[0])(*cmd[1:])
+        try:
+            return pipe.execute()[len(pending):]
+        except ConnectionError:
+            counters.buffer.restore(self._model, pending)
+            raise
+
+    @pipeline_timer
+    def execute_script(self, instance, cmds):
+        """Execute all `cmds` atomically with one call of `apply` script
+        """
+        if not cmds:
+            return
+        pending = self.take_increments()
+        try:
+            return scripts.apply(self.connection, pending + list(cmds))
+        except ConnectionError:
+            counters.buffer.restore(self._model, pending)
+            raise
+
+    def take_increments(self):
+        """Remove pending buffered counter increments of model and
+        return their commands
+        """
+        return counters.buffer.take(self._model) if self._model is not None else []
 
     def contribute_to_class(self, model, name):
         self._model = model
         self._name = name
-        self._model._connection = self._connection
         setattr(model, name, ManagerDescriptor(self))
 
 
@@ -9,14 +9,59 @@ Models for Object-hash mapping library for Redis
 :license: BSD, see LICENSE for more details.
 """
 
+from collections import deque
+from oredis import instrumentation
 from oredis.manager import Manager
-from oredis.exceptions import NotFoundError
-from oredis.fields import Field, PrimaryKey
+from oredis.exceptions import NotFoundError, ImplementationError
+from oredis.fields import Field, PrimaryKey, Composite, Prefetched
+from oredis.connections import DEFAULT_ALIAS
+from oredis import cache
+from oredis.cache import ObjectCache
+
+
+STORAGES = ('keys', 'hash')
+
+# instance attributes of models with `slots` option
+SLOTS = ('_data', '_fetched', '_bound', '_dirty', '_loaded', '_queries', '_queries_counter', '__weakref__')
+
+
+class Options(object):
+    """Model options declared in inner `Meta` class
+
+    storage: 'keys' stores every field in own key (default),
+             'hash' keeps scalar fields of instance in one redis hash
+    using: alias of shared connection, see `oredis.connections`
+    cache_size: number of instances kept in local LRU cache, 0 disables it
+    cache_ttl: seconds cached instance is valid, None for no expiration
+    cache_invalidation: publish changes of instances so listeners in other
+                        processes evict them, see `oredis.cache.start_listener`
+    slots: store instance state in `__slots__` instead of `__dict__`, such
+           instances do not accept other attributes
+    """
+    def __init__(self, meta=None):
+        self.using = getattr(meta, 'using', DEFAULT_ALIAS)
+        self.cache_size = getattr(meta, 'cache_size', 0)
+        self.cache_ttl = getattr(meta, 'cache_ttl', None)
+        self.cache_invalidation = getattr(meta, 'cache_invalidation', False)
+        self.storage = getattr(meta, 'storage', 'keys')
+        self.slots = getattr(meta, 'slots', False)
+        if self.storage not in STORAGES:
+            raise ImplementationError('storage must be one of %s' % ', '.join(STORAGES))
 
 
 class BaseModel(type):
     def __new__(cls, name, bases, attrs):
+        options = Options(attrs.pop('Meta', None))
+        if options.slots and '__slots__' not in attrs:
+            slotted = any(base.__dict__.get('__slots__') for base in bases)
+            attrs['__slots__'] = () if slotted else SLOTS
         new = type.__new__(cls, name, bases, attrs)
+        new._meta = options
+        new._cache = None
+        if new._meta.cache_size:
+            new._cache = ObjectCache(new._meta.cache_size, new._meta.cache_ttl)
+            if new._meta.cache_invalidation:
+                cache.register(new.key(), new._cache)
         new._fields = {}
         new._managers = {}
         module = attrs['__module__']
@@ -38,28 +83,42 @@ class BaseModel(type):
             field = PrimaryKey()
             new._fields['id'] = field
             field.contribute_to_class(new, 'id')
+        # fields that do something on creation of every instance
+        new._post_init_fields = [field for field in new._fields.values()
+                                 if field.__class__.__post_init__.im_func is not Field.__post_init__.im_func]
         excdict = {'__module__': module}
         new.NotFound = type('NotFound', (NotFoundError, ), excdict)
         return new
 
+    @property
+    def _connection(cls):
+        return cls._managers['objects'].connection
+
 
 class Model(object):
     __metaclass__ = BaseModel
+    # subclasses without `slots` option get usual `__dict__`
+    __slots__ = ()
     _redis = None
-    _connection = None
     _manager = None
 
     def __init__(self, **kwargs):
         if self.__class__ == Model:
             raise NotImplementedError('Model must be subclassed')
         self._data = {}
-        self._queries = []
+        # sets of fetched and changed fields and bound collections are
+        # created on first use
+        self._fetched = None
+        self._bound = None
+        self._dirty = None
+        self._loaded = False
+        self._queries = None
         self._queries_counter = 0
         for n, field in self._fields.items():
-            self._data[n] = kwargs.get(n, None) or self._fields[n].default
+            value = kwargs.get(n)
+            self._data[n] = field.default if value is None else value
+        for field in self._post_init_fields:
             field.__post_init__(self)
-            self._loaded = False
-
 
     def __str__(self):
         return u"%s object" % self.__class__.__name__
@@ -76,15 +135,55 @@ class Model(object):
     def __hash__(self):
         return hash(self.id)
 
+    def copy(self, collections=True):
+        """Copy of instance with own values, fetched and changed fields.
+        Without `collections` values of collection fields are not copied
+        and are loaded on access.
+        """
+        new = self.__class__.__new__(self.__class__)
+        skipped = () if collections else [name for name, field in self._fields.items()
+                                          if isinstance(field, Composite)]
+        new._data = dict((name, None if name in skipped else self._fields[name].copy_value(value))
+                         for name, value in self._data.items())
+        new._fetched = set(name for name in self._fetched or () if name not in skipped) or None
+        new._bound = None
+        new._dirty = set(self._dirty) if self._dirty else None
+        new._loaded = self._loaded
+        new._queries = None
+        new._queries_counter = 0
+        return new
+
     def get_field(self, field_name, default = None):
         value = self._data.get(field_name, None)
-        if not value and hasattr(default, "__call__"):
+        if value is None and hasattr(default, "__call__"):
             value = default(self)
-        elif not value and hasattr(self._fields[field_name].default, '__call__'):
+        elif value is None and hasattr(self._fields[field_name].default, '__call__'):
             value = self._fields[field_name].default()
-        if self._loaded and not value:
+        if self._loaded and value is None and not self.is_fetched(field_name):
             return self._fields[field_name].load(self)
-        return self.set_field(field_name, value or self._fields[field_name].default)
+        return self.set_field(field_name, self._fields[field_name].default if value is None else value)
+
+    def is_fetched(self, name):
+        return self._fetched is not None and name in self._fetched
+
+    def set_fetched(self, name, fetched=True):
+        """Mark field as loaded from redis or assigned, or with `fetched`
+        False as not loaded
+        """
+        if fetched:
+            if self._fetched is None:
+                self._fetched = set()
+            self._fetched.add(name)
+        elif self._fetched is not None:
+            self._fetched.discard(name)
+
+    def is_dirty(self, name):
+        return self._dirty is not None and name in self._dirty
+
+    def set_dirty(self, name):
+        if self._dirty is None:
+            self._dirty = set()
+        self._dirty.add(name)
 
     def set_field(self, field, value):
         self._data[field] = value
@@ -94,49 +193,283 @@ class Model(object):
         self._queries_counter += 1
 
     def update_queries(self, query):
+        if self._queries is None:
+            self._queries = deque(maxlen=instrumentation.log_size)
         self._queries.append(query)
         self.update_counter()
 
     def get_queries(self):
-        total_time = 0
-        for x in self._queries:
-            total_time += x[-1]
+        """Commands recorded for instance while instrumentation is enabled,
+        as (command, key, duration, payload size) tuples
+        """
+        queries = list(self._queries or [])
         return {
             'model': self.__class__.  __name__.lower(),
             'count': self._queries_counter,
-            'queries': self._queries,
-            'total_time': total_time
+            'queries': queries,
+            'total_time': sum(x[2] for x in queries)
             }
 
+    @classmethod
+    def get_query_stats(cls):
+        """Aggregated statistics of commands recorded for model
+        """
+        return instrumentation.get_log(cls).as_dict()
+
 
     @property
     def redis(self):
-        return self._connection
+        return self.__class__._connection
 
     @classmethod
     def key(cls, *args):
         return ':'.join((cls.__name__.lower(), ) + args)
 
-    def validate(self):
-        for field in self._fields.values():
+    def validate(self, fields=None):
+        for name in self._fields if fields is None else fields:
+            field = self._fields[name]
             field.validate(field.__get__(self))
         return True
 
-    def save(self):
-        self.validate()
-        for name, field in self._fields.items():
-            field.save(self)
+    def save(self, update_fields=None):
+        """Store instance and update its indexes atomically with one
+        call of `apply` script.
+
+        New instance is stored whole, even with `update_fields`, loaded one
+        only with fields changed since loading or with `update_fields`.
+        """
+        for name in update_fields or ():
+            if name not in self._fields:
+                raise ImplementationError('%s has no field %s' % (self.__class__.__name__, name))
+        if not self._loaded:
+            update_fields = None
+        elif update_fields is None:
+            update_fields = self.changed_fields()
+        self.validate(update_fields)
+        cmds = self.savecmds(update_fields)
+        if cmds:
+            self._managers['objects'].execute_script(self, cmds)
+        if self._dirty is not None:
+            self._dirty.difference_update(update_fields or self._fields)
+        self._loaded = True
+        self.evict()
         return True
 
+    def changed_fields(self):
+        """Names of fields assigned since loading and of fields with
+        serialized values, which may be changed in place
+        """
+        return [name for name, field in self._fields.items()
+                if self.is_dirty(name) or (field.serializer is not None and self._data.get(name) is not None)]
+
+    def savecmds(self, fields=None):
+        """Commands of `apply` script that store `fields`, by default all
+        fields of new instance or changed fields of loaded one
+        """
+        if fields is None:
+            fields = self.changed_fields() if self._loaded else self._fields.keys()
+        cmds, index, mapping = [], [], {}
+        for name in fields:
+            field = self._fields[name]
+            savecmds = field.savecmds(self)
+            if field.scalar and self._loaded and self.is_dirty(name) and self._data.get(name) is None:
+                # value was cleared
+                cmds.extend(field.deletecmds(self))
+                if field.index:
+                    index.extend(field.indexcmds(self, True))
+                if field.sorted_index:
+                    cmds.extend(field.unsortcmds(self))
+                continue
+            for cmd in savecmds:
+                # hashed fields are written with single HMSET
+                if cmd[0] == 'hset' and field.hashed:
+                    mapping[cmd[2]] = cmd[3]
+                else:
+                    cmds.append(cmd)
+            if field.index and savecmds:
+                index.extend(field.indexcmds(self))
+            if field.sorted_index and savecmds:
+                cmds.extend(field.sortcmds(self))
+        if mapping:
+            cmds.insert(0, ('hmset', self.key(str(self.id)), mapping))
+        # old indexed values are read before they are overwritten
+        cmds = index + cmds
+        return cmds + self.invalidatecmds() if cmds else []
+
     def delete(self):
-        for name, field in self._fields.items():
-            field.delete(self)
+        self._managers['objects'].execute_script(self, self.deletecmds())
+        if self._cache is not None:
+            self._cache.delete(self.key(str(self.id)))
         return True
 
+    def deletecmds(self, command='delete'):
+        """Commands of `apply` script that remove instance, all its keys
+        are removed with single `command` (DEL or UNLINK)
+        """
+        cmds, index, keys, hashed = [], [], [], False
+        for name, field in self._fields.items():
+            for cmd in field.deletecmds(self):
+                if cmd[0] == 'hdel' and field.hashed:
+                    hashed = True
+                elif cmd[0] == 'delete':
+                    keys.extend(cmd[1:])
+                else:
+                    cmds.append(cmd)
+            if field.index:
+                index.extend(field.indexcmds(self, True))
+            if field.sorted_index:
+                cmds.extend(field.unsortcmds(self))
+        if hashed:
+            keys.insert(0, self.key(str(self.id)))
+        if keys:
+            cmds.insert(0, (command, ) + tuple(keys))
+        return index + cmds + self.invalidatecmds()
+
+    def invalidatecmds(self):
+        """Commands that notify other processes about changed instance
+        """
+        if self._cache is None or not self._meta.cache_invalidation:
+            return []
+        return [('publish', cache.CHANNEL, cache.message(self.key(str(self.id))))]
+
+    def evict(self, publish=False):
+        """Remove cached copy of instance from local cache and, if
+        `publish` is True, from caches of other processes
+        """
+        if self._cache is not None:
+            self._cache.delete(self.key(str(self.id)))
+        if publish:
+            for cmd in self.invalidatecmds():
+                self.redis.publish(*cmd[1:])
+
+    @classmethod
+    def get_cache_stats(cls):
+        return cls._cache.stats() if cls._cache is not None else None
+
     @classmethod
     def get(cls, id):
+        if cls._cache is not None:
+            # instances are cached with scalar fields loaded
+            objects = cls.get_many([id])
+            if not objects:
+                raise cls.NotFound('%s with id %s is not found' % (cls.__name__, id))
+            return objects[0]
         if not cls._connection.sismember(cls.id.key(), id):
             raise cls.NotFound('%s with id %s is not found' % (cls.__name__, id))
+        return cls._from_id(id)
+
+    @classmethod
+    def scalar_fields(cls):
+        return [name for name, field in cls._fields.items() if field.scalar]
+
+    @classmethod
+    def get_many(cls, ids, fields=None):
+        """Load instances with given `ids` in one round trip.
+
+        Membership of every id and values of `fields` (scalar fields by
+        default) are fetched with a single pipeline. Missing ids are skipped.
+        """
+        if cls._cache is None:
+            return cls.load_many([cls._from_id(id) for id in ids], fields, True)
+        objects, missing = [], []
+        for id in ids:
+            obj = cls._cache.get(cls.key(str(cls.id.to_python(id))))
+            if obj is None:
+                obj = cls._from_id(id)
+                missing.append(obj)
+            else:
+                obj = obj.copy()
+            objects.append(obj)
+        version = cls._cache.version
+        found = cls.load_many(missing, fields, True)
+        # cached instances are never returned, callers get own copies,
+        # collections are not cached
+        for obj in found:
+            cls._cache.set(obj.key(str(obj.id)), obj.copy(False), version)
+        absent = set(missing) - set(found)
+        return [obj for obj in objects if obj not in absent]
+
+    @classmethod
+    def load_many(cls, objects, fields=None, check=False):
+        """Fetch values of `fields` (scalar fields by default) for all
+        `objects` with one pipeline. Collections are loaded only when
+        named in `fields`, otherwise on first access.
+
+        If `check` is True membership of every instance is verified in the
+        same pipeline and only existing instances are returned.
+        """
+        names = cls.scalar_fields() if fields is None else list(fields)
+        for name in names:
+            if name not in cls._fields:
+                raise ImplementationError('%s has no field %s' % (cls.__name__, name))
+        hashed = [name for name in names if cls._fields[name].hashed]
+        names = [name for name in names if not cls._fields[name].hashed]
+        cmds, plan = [], []
+        for obj in objects:
+            if check:
+                cmds.append(('sismember', cls.id.key(), obj.id))
+                plan.append((obj, None))
+            if hashed:
+                cmds.append(('hmget', obj.key(str(obj.id)), hashed))
+                plan.append((obj, hashed))
+            for name in names:
+                cmd = cls._fields[name].loadcmd(obj)
+                if cmd:
+                    cmds.append(cmd)
+                    plan.append((obj, name))
+        replies = cls._managers['objects'].execute_pipeline(None, cmds)
+        missing = set()
+        for (obj, loaded), reply in zip(plan, replies):
+            if loaded is None:
+                if not reply:
+                    missing.add(obj)
+                continue
+            pairs = zip(loaded, reply) if loaded is hashed else [(loaded, reply)]
+            for name, value in pairs:
+                obj.set_field(name, cls._fields[name].decode(value))
+                obj.set_fetched(name)
+        return [obj for obj in objects if obj not in missing]
+
+    @classmethod
+    def load_related(cls, objects, names):
+        """Replace ids in FK fields `names` of all `objects` with instances
+        loaded with one round trip per field
+        """
+        for name in names:
+            field = cls._fields[name]
+            ids = set(obj._data.get(name) for obj in objects)
+            ids = [id for id in ids if id is not None and not isinstance(id, Model)]
+            if not ids:
+                continue
+            targets = dict((str(x.id), x) for x in field.to.get_many(ids))
+            for obj in objects:
+                value = obj._data.get(name)
+                if value is not None and not isinstance(value, Model) and str(value) in targets:
+                    obj.set_field(name, targets[str(value)])
+        return objects
+
+    @classmethod
+    def load_links(cls, objects, names):
+        """Load members of Link fields `names` of all `objects` and linked
+        instances with one round trip per field
+        """
+        for name in names:
+            field = cls._fields[name]
+            cls.load_many([obj for obj in objects if not obj.is_fetched(name)], [name])
+            ids = set()
+            for obj in objects:
+                ids.update(obj._data.get(name) or ())
+            targets = dict((field.raw(x.id), x) for x in field.to.get_many(ids)) if ids else {}
+            for obj in objects:
+                obj.set_field(name, Prefetched(obj._data.get(name) or (), targets))
+        return objects
+
+    @classmethod
+    def _from_id(cls, id):
         new_model = cls(id=cls.id.to_python(id))
+        # stored values replace defaults when fields are loaded
+        for name in cls._fields:
+            if name != 'id':
+                new_model._data[name] = None
         new_model._loaded = True
         return new_model
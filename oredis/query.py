@@ -0,0 +1,322 @@
+# -*- coding:  utf-8 -*-
+"""
+oredis.query
+~~~~~~~~~~~~
+
+Queries over model indexes
+
+:copyright: (c) 2011 by Alexandr Lispython (alex@obout.ru).
+:license: BSD, see LICENSE for more details.
+"""
+
+import uuid
+from oredis.exceptions import ImplementationError
+
+
+LOOKUPS = ('exact', 'gt', 'gte', 'lt', 'lte')
+
+# lifetime of intermediate keys, refreshed on every batch
+TEMP_TTL = 300
+
+
+class QuerySet(object):
+    """Lazy query over index sets of model
+
+    Equality lookups are resolved with index sets, range lookups and
+    ordering with sorted indexes. Nothing is sent to redis until queryset
+    is iterated; results are then streamed in batches of `batch_size`
+    ids (SSCAN for sets, windowed ZRANGEBYSCORE for sorted indexes) and
+    fields of every batch are loaded with one pipeline. Results are not
+    cached, every iteration queries redis again.
+
+    Unordered iteration uses SSCAN and may yield instance twice if index
+    is changed during iteration.
+    """
+    batch_size = 100
+
+    def __init__(self, model):
+        self._model = model
+        self._keys = []
+        self._ranges = {}
+        self._ordering = None
+        self._fields = None
+        self._related = []
+        self._prefetch = []
+        self._start = 0
+        self._stop = None
+
+    def __repr__(self):
+        return u'<%s: %s>' % (self.__class__.__name__, self._model.__name__)
+
+    def _clone(self, **kwargs):
+        new = self.__class__(self._model)
+        new._keys = list(self._keys)
+        new._ranges = dict(self._ranges)
+        new._ordering = self._ordering
+        new._fields = self._fields
+        new._related = list(self._related)
+        new._prefetch = list(self._prefetch)
+        new._start = self._start
+        new._stop = self._stop
+        new.batch_size = self.batch_size
+        for name, value in kwargs.items():
+            setattr(new, name, value)
+        return new
+
+    def _field(self, name):
+        field = self._model._fields.get(name)
+        if field is None:
+            raise ImplementationError('%s has no field %s' % (self._model.__name__, name))
+        return field
+
+    def all(self):
+        return self._clone()
+
+    def filter(self, **kwargs):
+        new = self._clone()
+        for lookup, value in kwargs.items():
+            name, op = lookup.split('__', 1) if '__' in lookup else (lookup, 'exact')
+            if op not in LOOKUPS:
+                raise ImplementationError('unsupported lookup %s' % lookup)
+            field = self._field(name)
+            if op == 'exact' and field.index:
+                new._keys.append(field.index_key(value))
+                continue
+            if not field.sorted_index:
+                raise ImplementationError('%s is not indexed' % field.pyname)
+            score = field.to_score(value)
+            low, high = new._ranges.get(name, ('-inf', '+inf'))
+            if op in ('exact', 'gt', 'gte'):
+                low = '(%r' % score if op == 'gt' else repr(score)
+            if op in ('exact', 'lt', 'lte'):
+                high = '(%r' % score if op == 'lt' else repr(score)
+            new._ranges[name] = (low, high)
+        return new
+
+    def order_by(self, name):
+        desc = name.startswith('-')
+        field = self._field(name.lstrip('-'))
+        if not field.sorted_index:
+            raise ImplementationError('%s has no sorted index' % field.pyname)
+        return self._clone(_ordering=(field._name, desc))
+
+    def only(self, *fields):
+        """Load only given fields of every instance
+        """
+        for name in fields:
+            self._field(name)
+        return self._clone(_fields=list(fields))
+
+    def select_related(self, *fields):
+        """Load instances referenced by FK `fields` together with every
+        batch of results
+        """
+        for name in fields:
+            if self._field(name).get_internal_type() != 'FK':
+                raise ImplementationError('%s is not FK field' % self._field(name).pyname)
+        return self._clone(_related=self._related + list(fields))
+
+    def prefetch_related(self, *fields):
+        """Load members of Link `fields` and linked instances together with
+        every batch of results
+        """
+        for name in fields:
+            if self._field(name).get_internal_type() != 'Link':
+                raise ImplementationError('%s is not Link field' % self._field(name).pyname)
+        return self._clone(_prefetch=self._prefetch + list(fields))
+
+    def batch(self, size):
+        """Set number of instances fetched per round trip
+        """
+        return self._clone(batch_size=int(size))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if index.step is not None or (index.start or 0) < 0 or (index.stop or 0) < 0:
+                raise ImplementationError('only positive slices without step are supported')
+            new = self._clone(_start=self._start + (index.start or 0))
+            if index.stop is not None:
+                stop = self._start + index.stop
+                new._stop = stop if self._stop is None else min(stop, self._stop)
+            return new
+        result = list(self[index:index + 1])
+        if not result:
+            raise IndexError('queryset index out of range')
+        return result[0]
+
+    def __iter__(self):
+        model = self._model
+        for ids in self._batches():
+            objects = [model._from_id(id) for id in ids]
+            objects = model.load_many(objects, self._load_fields() + self._prefetch)
+            if self._related:
+                model.load_related(objects, self._related)
+            if self._prefetch:
+                model.load_links(objects, self._prefetch)
+            for obj in objects:
+                yield obj
+
+    def __nonzero__(self):
+        return self.exists()
+
+    def ids(self):
+        """Iterate over raw ids without loading instances
+        """
+        for ids in self._batches():
+            for id in ids:
+                yield id
+
+    def count(self):
+        setup, key, ordered, low, high, temp = self._plan()
+        if ordered:
+            cmd = ('zcount', key, low, high)
+        else:
+            cmd = ('scard', key)
+        total = self._execute(setup + [cmd] + self._cleanup(temp), bool(temp))[len(setup)]
+        total = max(total - self._start, 0)
+        if self._stop is not None:
+            total = min(total, self._stop - self._start)
+        return total
+
+    def exists(self):
+        return self.count() > 0
+
+    def delete(self, chunk_size=500):
+        """Remove all matching instances, see `Manager.bulk_delete`.
+
+        Ids of unsliced queryset without ranges and ordering are streamed
+        with SSCAN into removal, set is scanned again until nothing is
+        removed, so members skipped while set shrinks are removed too. Rare
+        ids returned twice by SSCAN are counted twice. Ids of other
+        querysets are collected before removal, because removal shifts
+        positions of ids in sorted indexes. Return number of removed
+        instances.
+        """
+        manager = self._model._managers['objects']
+        queryset = self.batch(max(self.batch_size, chunk_size))
+        if self._ranges or self._ordering or self._start or self._stop is not None:
+            return manager.bulk_delete(list(queryset.ids()), chunk_size)
+        total = 0
+        while True:
+            count = manager.bulk_delete(queryset.ids(), chunk_size)
+            if not count:
+                return total
+            total += count
+
+    def _load_fields(self):
+        if self._fields is not None:
+            return self._fields + [x for x in self._related if x not in self._fields]
+        return self._model.scalar_fields()
+
+    def _execute(self, cmds, transaction=False):
+        return self._model._managers['objects'].execute_pipeline(None, cmds, transaction)
+
+    def _temp_key(self):
+        return self._model.key('tmp', uuid.uuid4().hex)
+
+    def _cleanup(self, temp):
+        return [('delete', ) + tuple(temp)] if temp else []
+
+    def _plan(self):
+        """Return commands that prepare key to read ids from.
+
+        Result is tuple of (setup commands, key, is sorted, low score,
+        high score, temporary keys).
+        """
+        model = self._model
+        if not self._ranges and not self._ordering:
+            if len(self._keys) <= 1:
+                return [], (self._keys or [model.id.key()])[0], False, None, None, []
+            key = self._temp_key()
+            return [('sinterstore', key, self._keys)], key, False, None, None, [key]
+
+        if self._ordering:
+            base = self._ordering[0]
+        else:
+            base = sorted(self._ranges)[0]
+        low, high = self._ranges.get(base, ('-inf', '+inf'))
+        key = model._fields[base].sorted_key()
+        others = [name for name in self._ranges if name != base]
+        if not self._keys and not others:
+            return [], key, True, low, high, []
+        # narrow ordered index with other conditions into temporary key
+        cmds, temp, weights = [], [], {key: 1}
+        for name in others:
+            tmp = self._temp_key()
+            temp.append(tmp)
+            cmds.extend(self._rangestore(tmp, model._fields[name].sorted_key(), *self._ranges[name]))
+            weights[tmp] = 0
+        for name in self._keys:
+            weights[name] = 0
+        key = self._temp_key()
+        temp.append(key)
+        cmds.append(('zinterstore', key, weights))
+        return cmds, key, True, low, high, temp
+
+    def _rangestore(self, dest, key, low, high):
+        """Commands to copy part of sorted set between `low` and `high`
+        into `dest`
+        """
+        cmds = [('zunionstore', dest, [key])]
+        if low != '-inf':
+            cmds.append(('zremrangebyscore', dest, '-inf', low[1:] if low.startswith('(') else '(' + low))
+        if high != '+inf':
+            cmds.append(('zremrangebyscore', dest, high[1:] if high.startswith('(') else '(' + high, '+inf'))
+        return cmds
+
+    def _batches(self):
+        """Generate lists of ids, one list per round trip
+        """
+        if self._stop is not None and self._stop <= self._start:
+            return
+        setup, key, ordered, low, high, temp = self._plan()
+        if setup:
+            self._execute(setup + [('expire', x, TEMP_TTL) for x in temp], True)
+        try:
+            if ordered:
+                batches = self._zrange_batches(key, low, high)
+            else:
+                batches = self._scan_batches(key)
+            for ids in batches:
+                if temp:
+                    self._execute([('expire', x, TEMP_TTL) for x in temp])
+                yield ids
+        finally:
+            if temp:
+                self._execute(self._cleanup(temp))
+
+    def _zrange_batches(self, key, low, high):
+        desc = self._ordering and self._ordering[1]
+        offset = self._start
+        while self._stop is None or offset < self._stop:
+            num = self.batch_size
+            if self._stop is not None:
+                num = min(num, self._stop - offset)
+            if desc:
+                cmd = ('zrevrangebyscore', key, high, low, offset, num)
+            else:
+                cmd = ('zrangebyscore', key, low, high, offset, num)
+            ids = self._execute([cmd])[0]
+            if not ids:
+                return
+            yield ids
+            if len(ids) < num:
+                return
+            offset += len(ids)
+
+    def _scan_batches(self, key):
+        skip, left = self._start, None
+        if self._stop is not None:
+            left = self._stop - self._start
+        cursor = 0
+        while True:
+            cursor, ids = self._execute([('sscan', key, cursor, None, self.batch_size)])[0]
+            if skip:
+                skipped, ids = ids[:skip], ids[skip:]
+                skip -= len(skipped)
+            if left is not None:
+                ids, left = ids[:left], left - min(left, len(ids))
+            if ids:
+                yield ids
+            if not int(cursor) or left == 0:
+                return
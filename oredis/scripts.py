@@ -0,0 +1,130 @@
+# -*- coding:  utf-8 -*-
+"""
+oredis.scripts
+~~~~~~~~~~~~~~
+
+Lua scripts that change several keys of model atomically
+
+Scripts are registered once and invoked with EVALSHA, script is sent with
+SCRIPT LOAD only when server does not know it yet.
+
+:copyright: (c) 2011 by Alexandr Lispython (alex@obout.ru).
+:license: BSD, see LICENSE for more details.
+"""
+
+from hashlib import sha1
+from redis.exceptions import NoScriptError
+from oredis.exceptions import ImplementationError
+
+
+_registry = {}
+
+# commands of redis-py whose names differ from redis commands
+COMMANDS = {'delete': 'del'}
+
+
+class Script(object):
+    def __init__(self, name, source):
+        self.name = name
+        self.source = source
+        self.sha = sha1(source).hexdigest()
+
+    def __repr__(self):
+        return u'<%s: %s>' % (self.__class__.__name__, self.name)
+
+    def __call__(self, connection, keys=(), args=()):
+        keys_and_args = list(keys) + list(args)
+        try:
+            return connection.evalsha(self.sha, len(keys), *keys_and_args)
+        except NoScriptError:
+            connection.script_load(self.source)
+            return connection.evalsha(self.sha, len(keys), *keys_and_args)
+
+
+def register(name, source):
+    script = _registry[name] = Script(name, source)
+    return script
+
+
+def get_script(name):
+    script = _registry.get(name)
+    if script is None:
+        raise ImplementationError('script %s is not registered' % name)
+    return script
+
+
+def load(connection):
+    """Load all registered scripts with SCRIPT LOAD
+    """
+    for script in _registry.values():
+        connection.script_load(script.source)
+
+
+def flatten(args):
+    for arg in args:
+        if isinstance(arg, dict):
+            arg = arg.items()
+        if isinstance(arg, (list, tuple)):
+            for item in flatten(arg):
+                yield item
+        else:
+            yield arg
+
+
+def pack(cmds):
+    """Flatten commands into arguments of `apply` script,
+    every command is prefixed with number of its parts
+    """
+    args = []
+    for cmd in cmds:
+        if cmd[0] == 'zadd':
+            # redis-py Redis class sends member before score
+            cmd = (cmd[0], cmd[1], cmd[3], cmd[2])
+        parts = [COMMANDS.get(cmd[0], cmd[0])] + list(flatten(cmd[1:]))
+        args.append(len(parts))
+        args.extend(parts)
+    return args
+
+
+def apply(connection, cmds):
+    """Execute `cmds` atomically in one call of `apply` script.
+
+    Pseudo command ('reindex', mode, prefix, id, value, read command...)
+    reads value stored in redis with read command and moves id from index
+    set `prefix + old value` to `prefix + value` ('set' mode) or only
+    removes it from old index set ('del' mode).
+    """
+    return get_script('apply')(connection, args=pack(cmds))
+
+
+register('apply', """
+local unpack = unpack or table.unpack
+local i = 1
+while i <= #ARGV do
+    local n = tonumber(ARGV[i])
+    local cmd = {unpack(ARGV, i + 1, i + n)}
+    i = i + n + 1
+    if cmd[1] == 'reindex' then
+        local old = redis.call(unpack(cmd, 6))
+        if old and (cmd[2] == 'del' or old ~= cmd[5]) then
+            redis.call('srem', cmd[3] .. old, cmd[4])
+        end
+        if cmd[2] == 'set' then
+            redis.call('sadd', cmd[3] .. cmd[5], cmd[4])
+        end
+    else
+        redis.call(unpack(cmd))
+    end
+end
+""")
+
+
+register('ldelete', """
+local value = redis.call('lindex', KEYS[1], ARGV[1])
+if not value then
+    return redis.error_reply('index out of range')
+end
+redis.call('lset', KEYS[1], ARGV[1], ARGV[2])
+redis.call('lrem', KEYS[1], 1, ARGV[2])
+return value
+""")
@@ -0,0 +1,128 @@
+# -*- coding:  utf-8 -*-
+"""
+oredis.serializers
+~~~~~~~~~~~~~~~~~~
+
+Serialization of field values stored in redis
+
+:copyright: (c) 2011 by Alexandr Lispython (alex@obout.ru).
+:license: BSD, see LICENSE for more details.
+"""
+
+import json
+import zlib
+from oredis.exceptions import ImplementationError
+
+
+class Raw(object):
+    """Store value as is
+    """
+    def dumps(self, value):
+        return value
+
+    def loads(self, data):
+        return data
+
+
+class JSON(object):
+    def dumps(self, value):
+        return json.dumps(value, separators=(',', ':'))
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class Msgpack(object):
+    def __init__(self):
+        try:
+            import msgpack
+        except ImportError:
+            raise ImplementationError('msgpack serializer requires msgpack package')
+        self.msgpack = msgpack
+
+    def dumps(self, value):
+        return self.msgpack.packb(value, use_bin_type=True)
+
+    def loads(self, data):
+        return self.msgpack.unpackb(data, raw=False)
+
+
+def lz4_codec():
+    try:
+        import lz4.frame
+    except ImportError:
+        raise ImplementationError('lz4 compression requires lz4 package')
+    return lz4.frame.compress, lz4.frame.decompress
+
+
+# codec name: (one byte tag, function returning compress and decompress)
+CODECS = {
+    'zlib': ('z', lambda: (zlib.compress, zlib.decompress)),
+    'lz4': ('4', lz4_codec)
+    }
+
+# tag of values stored without compression
+PLAIN = 'n'
+
+
+class Compressed(object):
+    """Compress serialized values of `threshold` bytes and longer.
+
+    Every stored value starts with one byte tag of codec, so threshold and
+    codec may be changed without migration of stored data.
+    """
+    def __init__(self, serializer, threshold=1024, codec='zlib'):
+        if codec not in CODECS:
+            raise ImplementationError('compression must be one of %s' % ', '.join(CODECS))
+        self.serializer = serializer
+        self.threshold = threshold
+        self.tag = CODECS[codec][0]
+        self.compress = CODECS[codec][1]()[0]
+        self._decompressors = {}
+
+    def dumps(self, value):
+        data = self.serializer.dumps(value)
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        elif not isinstance(data, str):
+            data = str(data)
+        if len(data) >= self.threshold:
+            return self.tag + self.compress(data)
+        return PLAIN + data
+
+    def loads(self, data):
+        tag, data = data[:1], data[1:]
+        if tag != PLAIN:
+            data = self.decompressor(tag)(data)
+        return self.serializer.loads(data)
+
+    def decompressor(self, tag):
+        decompress = self._decompressors.get(tag)
+        if decompress is None:
+            for codec_tag, codec in CODECS.values():
+                if codec_tag == tag:
+                    decompress = self._decompressors[tag] = codec()[1]
+                    break
+            else:
+                raise ValueError('unknown compression of stored value')
+        return decompress
+
+
+SERIALIZERS = {
+    'raw': Raw,
+    'json': JSON,
+    'msgpack': Msgpack
+    }
+
+
+def get_serializer(serializer=None, compress=None, codec='zlib'):
+    """Return serializer instance by name, optionally wrapped to compress
+    values longer than `compress` bytes with `codec`
+    """
+    if isinstance(serializer, basestring):
+        if serializer not in SERIALIZERS:
+            raise ImplementationError('serializer must be one of %s' % ', '.join(SERIALIZERS))
+        serializer = SERIALIZERS[serializer]()
+    if compress:
+        serializer = Compressed(serializer or Raw(), compress, codec)
+    return serializer
@@ -15,6 +15,8 @@ import time
 import types
 import datetime
 from decimal import Decimal
+from oredis import instrumentation
+from oredis.exceptions import ImplementationError
 
 
 def is_protected_type(obj):
@@ -76,30 +78,60 @@ def force_unicode(s, encoding='utf-8', strings_only=False, errors='strict'):
     return s
 
 
-def super_force_unicode(s):
+def detect_unicode(s):
+    """Decode byte string in encoding guessed by chardet
+    """
     try:
-        text = force_unicode(s)
-    except UnicodeDecodeError:
-        try:
-            from chardet import detect
-        except ImportError, e:
-            raise UnicodeDecodeError(u'Enconing fail')
-        else:
-            d = detect(s)
+        from chardet import detect
+    except ImportError:
+        raise ImplementationError('encoding detection requires chardet package')
+    encoding = detect(s).get('encoding')
+    if not encoding:
+        raise UnicodeDecodeError('unknown', s, 0, len(s), 'encoding is not detected')
+    return s.decode(encoding)
+
+
+def make_decoder(encoding='utf-8', errors='strict', detect=False):
+    """Return function that converts strings returned by redis to unicode.
+
+    Unicode values are returned as is and byte strings are decoded
+    directly, `force_unicode` is used only for other types. Encoding is
+    guessed with chardet only if `detect` is True.
+    """
+    def decode(s):
+        if s.__class__ is unicode:
+            return s
+        if s.__class__ is str:
             try:
-                s = text.decode(d.get('encoding'))
-            except:
-                raise UnicodeDecodeError(u'Enconing fail')
-    return s
+                return s.decode(encoding, errors)
+            except UnicodeDecodeError:
+                if not detect:
+                    raise
+                return detect_unicode(s)
+        return force_unicode(s, encoding, errors=errors)
+    return decode
+
+
+super_force_unicode = make_decoder(detect=True)
 
 
 def timer(f):
-    def tmp( *args, **kwargs):
-        cmd = args[2]
+    def tmp(*args, **kwargs):
+        if not instrumentation.sampled():
+            return f(*args, **kwargs)
+        t = time.time()
+        res = f(*args, **kwargs)
+        instrumentation.record(args[0]._model, args[1], [args[2]], time.time() - t)
+        return res
+    return tmp
+
+
+def pipeline_timer(f):
+    def tmp(*args, **kwargs):
+        if not instrumentation.sampled():
+            return f(*args, **kwargs)
         t = time.time()
         res = f(*args, **kwargs)
-        time_res = (time.time()-t)
-        ##print((" ".join(map(unicode, cmd)), time_res,  res))
-        args[1].update_queries((" ".join(map(unicode, cmd)), time_res))
+        instrumentation.record(args[0]._model, args[1], args[2], time.time() - t)
         return res
     return tmp
@@ -1,15 +1,25 @@
 # -*- coding:  utf-8 -*-
 
 from pprint import pprint
+import json
+import sys
+import time
 import unittest
 from random import random
+from datetime import datetime, timedelta
 from redis import Redis
-from oredis.exceptions import ValidationError
+from redis.exceptions import ConnectionError
+from oredis.exceptions import ValidationError, ImplementationError
 from oredis.models import (Model,  BaseModel)
-from oredis.fields import (Field,  String, PrimaryKey,  Integer,  StringPK,  FK,  Composite,  List,  Set,  Link,  HashTable)
+from oredis.fields import (Field,  String, PrimaryKey,  Integer,  StringPK,  FK,  Composite,  List,  Set,  Link,  HashTable, DateTime,
+                           Counter, Float, Decimal, Bytes, JSON)
+from decimal import Decimal as D
 from oredis.manager import Manager
+from oredis import instrumentation, cache, counters, scripts
+from oredis.connections import configure, get_connection, get_decoder
 
 r = Redis()
+instrumentation.enable()
 
 
     
@@ -47,6 +57,9 @@ class Author(Model):
     name = StringPK(require = False)
     tags = Link(TagModel)
 
+class Reader(Model):
+    tags = Link(TagModel, lazy = True)
+
     
 class Reply(Model):
     to = FK('self', required = False)
@@ -60,6 +73,100 @@ class UserProfile(Model):
     twitter = String()
 
     
+class HashedUser(Model):
+    name = String(required = True)
+    age = Integer()
+    tags = Set()
+
+    class Meta:
+        storage = 'hash'
+
+
+class Employee(Model):
+    name = String(required = True)
+    team = String(index = True)
+    level = Integer(index = True)
+    boss = FK(User, index = True)
+
+
+class Ticket(Model):
+    id = PrimaryKey(batch = 10)
+    title = String()
+
+
+class Document(Model):
+    data = JSON()
+    body = JSON(compress = 64)
+    raw = Bytes()
+    price = Decimal()
+    rating = Float(sorted_index = True)
+    lines = List(handler = None)
+
+    class Meta:
+        storage = 'hash'
+
+
+class Stats(Model):
+    name = String()
+    views = Counter()
+    likes = Counter(buffered = True)
+
+
+class HashedStats(Model):
+    views = Counter()
+    likes = Counter(buffered = True)
+
+    class Meta:
+        storage = 'hash'
+
+
+class Point(Model):
+    x = Integer()
+    y = Integer()
+    tags = Set()
+
+    class Meta:
+        slots = True
+
+
+class PlainPoint(Model):
+    x = Integer()
+    y = Integer()
+    tags = Set()
+
+
+class Post(Model):
+    group = String(index = True)
+    score = Integer(sorted_index = True)
+    created = DateTime(sorted_index = True)
+
+
+class CachedNote(Model):
+    text = String()
+
+    class Meta:
+        using = 'cache'
+
+
+class Setting(Model):
+    id = StringPK()
+    value = String()
+
+    class Meta:
+        cache_size = 2
+        cache_ttl = 60
+
+
+class SharedSetting(Model):
+    id = StringPK()
+    value = String()
+    tags = Set()
+
+    class Meta:
+        cache_size = 10
+        cache_invalidation = True
+
+
 class ArticleManager(Manager):
     def some_method(self):
         return "Some method work for model %s with name %s" % (self._model, self._name)
@@ -140,6 +247,509 @@ class OredisTestCase(unittest.TestCase):
         self.assertEqual(note.get_queries()['count'], 5)
         self.assertEqual(note_without_cid.get_queries()['count'], 6)
         
+    def testPipelinedSave(self):
+        note = NoteModel(
+            note = self.message,
+            css = self.css
+            )
+        note.save()
+        queries = note.get_queries()
+        self.assertEqual(queries['count'], 6)
+        self.assertEqual(queries['queries'][0][:2], ("incr", "notemodel"))
+        saved = NoteModel.get(note.id)
+        self.assertEqual(saved.note, note.note)
+        self.assertEqual(saved.comments, 0)
+        saved.delete()
+        self.assertRaises(NoteModel.NotFound, NoteModel.get, note.id)
+
+    def testGetMany(self):
+        users = [User(name = "user%d" % i, description = "bulk") for i in range(5)]
+        for user in users:
+            user.save()
+            user.tags.add('python')
+        ids = [x.id for x in users] + [-1]
+        loaded = User.get_many(ids)
+        self.assertEqual(loaded, users)
+        for user, original in zip(loaded, users):
+            self.assertEqual(user._loaded, True)
+            self.assertEqual(user.name, original.name)
+            self.assertEqual(user.get_queries()['count'], 0)
+            # collections are loaded on access
+            self.assertEqual(user.tags, set(['python']))
+            self.assertEqual(user.likes, [])
+            self.assertEqual(user.get_queries()['count'], 2)
+        for user in User.get_many(ids, ['name', 'tags', 'likes']):
+            self.assertEqual((user.tags, user.likes), (set(['python']), []))
+            self.assertEqual(user.get_queries()['count'], 0)
+        names = User.objects.in_bulk(ids, fields = ['name'])
+        self.assertEqual(sorted(names.keys()), sorted(x.id for x in users))
+        self.assertEqual(names[users[0].id].name, users[0].name)
+
+    def testHashStorage(self):
+        user = HashedUser(name = "Alexandr", age = 27)
+        user.save()
+        user.tags.add('python')
+        self.assertEqual(r.hgetall(HashedUser.key(str(user.id))), {'name': 'Alexandr', 'age': '27'})
+        self.assertEqual(r.exists(HashedUser.key(str(user.id), 'name')), False)
+        user2 = HashedUser.get(user.id)
+        self.assertEqual(user2.name, user.name)
+        self.assertEqual(user2.age, 27)
+        self.assertEqual(user2.get_queries()['count'], 1)
+        self.assertEqual(user2.tags, set(['python']))
+        user3 = HashedUser.get_many([user.id])[0]
+        self.assertEqual((user3.name, user3.age), (user.name, 27))
+        user.delete()
+        self.assertEqual(r.exists(HashedUser.key(str(user.id))), False)
+
+        old_id = r.incr(HashedUser.key())
+        r.sadd(HashedUser.id.key(), old_id)
+        r.set(HashedUser.key(str(old_id), 'name'), 'Legacy')
+        r.set(HashedUser.key(str(old_id), 'age'), 42)
+        self.assertEqual(HashedUser.objects.migrate_to_hash() >= 1, True)
+        self.assertEqual(r.exists(HashedUser.key(str(old_id), 'name')), False)
+        legacy = HashedUser.get(old_id)
+        self.assertEqual((legacy.name, legacy.age), ('Legacy', 42))
+
+    def testIndex(self):
+        boss = User(name = "Boss")
+        boss.save()
+        team = "team%s" % random()
+        alice = Employee(name = "Alice", team = team, level = 2, boss = boss)
+        bob = Employee(name = "Bob", team = team, level = 3, boss = boss)
+        carol = Employee(name = "Carol", team = team, level = 2)
+        for x in (alice, bob, carol):
+            x.save()
+        self.assertEqual(set(Employee.objects.filter(team = team)), set([alice, bob, carol]))
+        self.assertEqual(set(Employee.objects.filter(team = team, level = 2)), set([alice, carol]))
+        self.assertEqual(set(Employee.objects.filter(team = team, boss = boss)), set([alice, bob]))
+        self.assertEqual(Employee.objects.filter(team = team, level = 3)[0].name, "Bob")
+
+        bob = Employee.get(bob.id)
+        bob.level = 2
+        bob.save()
+        self.assertEqual(list(Employee.objects.filter(team = team, level = 3)), [])
+        self.assertEqual(Employee.objects.filter(team = team, level = 2).count(), 3)
+        carol.delete()
+        self.assertEqual(set(Employee.objects.filter(team = team, level = 2)), set([alice, bob]))
+        self.assertRaises(ImplementationError, Employee.objects.filter, name = "Alice")
+
+    def testScripts(self):
+        team = "team%s" % random()
+        dave = Employee(name = "Dave", team = team, level = 1)
+        dave.save()
+        stale = Employee.get(dave.id)
+        dave.team = team + "x"
+        dave.save()
+        stale.level = 5
+        stale.save()
+        # stale copy moved instance out of index of value saved meanwhile
+        self.assertEqual(list(Employee.objects.filter(team = team)), [])
+        self.assertEqual(list(Employee.objects.filter(team = team + "x", level = 5)), [dave])
+        stale.delete()
+        self.assertEqual(r.exists(Employee.team.index_key(team + "x")), False)
+
+        user = User(name = "Scripts")
+        user.save()
+        for x in ("a", "b", "a"):
+            user.likes.append(x)
+        self.assertEqual(user.likes, ["a", "b", "a"])
+        count = user.get_queries()['count']
+        del user.likes[-1]
+        self.assertEqual(user.get_queries()['count'] - count, 1)
+        self.assertEqual(user.likes, ["a", "b"])
+        self.assertEqual(User.get(user.id).likes, ["a", "b"])
+        self.assertRaises(IndexError, user.likes.__delitem__, 5)
+
+    def testBatchIds(self):
+        first = Ticket(title = "first")
+        first.save()
+        counter = int(r.get(Ticket.key()))
+        ids = [first.id]
+        for i in range(12):
+            ids.append(Ticket(title = "x").id)
+        self.assertEqual(ids, range(first.id, first.id + 13))
+        self.assertEqual(int(r.get(Ticket.key())), counter + 10)
+
+        team = "team%s" % random()
+        stats = Employee.get_query_stats()['commands']
+        incr = stats.get('incr', {}).get('count', 0)
+        employees = [Employee(name = "E%d" % i, team = team) for i in range(25)]
+        Employee.objects.bulk_create(employees, chunk_size = 10)
+        stats = Employee.get_query_stats()['commands']
+        self.assertEqual(stats.get('incr', {}).get('count', 0), incr)
+        self.assertEqual(len(set(x.id for x in employees)), 25)
+        self.assertEqual(Employee.objects.filter(team = team).count(), 25)
+        self.assertEqual(Employee.get(employees[-1].id).name, "E24")
+
+    def testBulkDelete(self):
+        team = "team%s" % random()
+        employees = Employee.objects.bulk_create(
+            [Employee(name = "E%d" % i, team = team, level = i % 2 + 1) for i in range(7)])
+        users = [User(name = "U%d" % i) for i in range(3)]
+        for user in users:
+            user.save()
+            user.likes.append("x")
+            user.tags.add("y")
+        self.assertEqual(User.objects.bulk_delete([x.id for x in users], chunk_size = 2), 3)
+        for user in users:
+            self.assertEqual(r.sismember(User.id.key(), user.id), False)
+            self.assertEqual(r.exists(User.likes.key(user)), False)
+            self.assertEqual(r.exists(User.name.key(user)), False)
+
+        self.assertEqual(Employee.objects.filter(team = team, level = 1).delete(chunk_size = 3), 4)
+        self.assertEqual(set(Employee.objects.filter(team = team)), set(employees[1::2]))
+        self.assertEqual(r.sinter(Employee.level.index_key(1), Employee.team.index_key(team)), set())
+        self.assertEqual(Employee.objects.filter(team = team).delete(), 3)
+        self.assertEqual(r.exists(Employee.team.index_key(team)), False)
+
+        team = "purge%s" % random()
+        Employee.objects.bulk_create([Employee(name = "P%d" % i, team = team) for i in range(25)])
+        self.assertEqual(Employee.objects.filter(team = team).batch(2).delete(chunk_size = 2), 25)
+        self.assertEqual(r.exists(Employee.team.index_key(team)), False)
+
+    def testSerializers(self):
+        body = {"text": u"текст " * 50}
+        doc = Document(data = {"a": [1, 2]}, body = body, raw = "\xff\x00",
+                       price = D("10.25"), rating = 4.5)
+        doc.save()
+        stored = r.hgetall(Document.key(str(doc.id)))
+        self.assertEqual(stored['data'], '{"a":[1,2]}')
+        self.assertEqual(stored['body'][0], 'z')
+        self.assertEqual(len(stored['body']) < len(json.dumps(body)), True)
+        loaded = Document.get(doc.id)
+        self.assertEqual(loaded.data, {"a": [1, 2]})
+        self.assertEqual(loaded.body, body)
+        self.assertEqual(loaded.raw, "\xff\x00")
+        self.assertEqual(loaded.price, D("10.25"))
+        self.assertEqual(loaded.rating, 4.5)
+        self.assertEqual(Document.get_many([doc.id])[0].data, {"a": [1, 2]})
+        self.assertEqual(str(doc.id) in list(Document.objects.filter(rating__gt = 4).ids()), True)
+        doc.lines.append("\xff")
+        self.assertEqual(Document.get(doc.id).lines, ["\xff"])
+        self.assertRaises(ImplementationError, JSON(index = True).contribute_to_class, Document, "other")
+        self.assertRaises(ValidationError, setattr, doc, "rating", "high")
+
+        empty = Document(data = [], body = {}, price = D("0"), rating = 0.0)
+        empty.save()
+        stored = r.hgetall(Document.key(str(empty.id)))
+        self.assertEqual((stored['data'], stored['rating'], stored['price']), ('[]', '0.0', '0'))
+        loaded = Document.get(empty.id)
+        self.assertEqual((loaded.data, loaded.body, loaded.price, loaded.rating), ([], {}, D("0"), 0.0))
+        self.assertEqual(str(empty.id) in list(Document.objects.filter(rating__lte = 0).ids()), True)
+
+    def testCounters(self):
+        stats = Stats(name = "counters")
+        stats.save()
+        self.assertEqual(stats.views, 0)
+        self.assertEqual(stats.views.incr(), 1)
+        self.assertEqual(stats.views.incr(5), 6)
+        self.assertEqual(stats.views.decr(2), 4)
+        stats.save()
+        self.assertEqual(Stats.get(stats.id).views, 4)
+        self.assertRaises(AttributeError, setattr, stats, 'views', 10)
+        self.assertTrue(stats.views > 1 and stats.views <= 4 and stats.views)
+        self.assertEqual((stats.views + 1, 1 + stats.views, stats.views * 2, stats.views / 2.0), (5, 5, 8, 2.0))
+        self.assertEqual(sorted([stats.views, 5, 1]), [1, 4, 5])
+        self.assertEqual({4: 'views'}[stats.views], 'views')
+        self.assertFalse(Stats(name = "empty").views)
+        hashed = HashedStats()
+        hashed.save()
+        hashed.views.incr(3)
+        self.assertEqual(r.hget(HashedStats.key(str(hashed.id)), 'views'), '3')
+
+        accumulator = counters.buffer
+        try:
+            counters.buffer = counters.Accumulator(interval = 60)
+            for i in range(10):
+                stats.likes.incr()
+            self.assertEqual(stats.likes, 10)
+            self.assertEqual(r.get(Stats.likes.key(stats)), None)
+            self.assertEqual(len(counters.buffer), 1)
+            Stats.get_many([stats.id])
+            self.assertEqual(r.get(Stats.likes.key(stats)), '10')
+            stats.likes.decr(4)
+            counters.buffer.flush()
+            self.assertEqual(Stats.get(stats.id).likes, 6)
+            self.assertEqual(len(counters.buffer), 0)
+
+            stats.likes.incr(2)
+            stats.name = "saved"
+            stats.save()
+            self.assertEqual(r.get(Stats.likes.key(stats)), '8')
+            stats.likes.incr()
+            apply = scripts.apply
+            def fail(*args):
+                raise ConnectionError()
+            try:
+                scripts.apply = fail
+                stats.name = "failed"
+                self.assertRaises(ConnectionError, stats.save)
+            finally:
+                scripts.apply = apply
+            self.assertEqual(len(counters.buffer), 1)
+            counters.buffer.flush()
+            self.assertEqual(r.get(Stats.likes.key(stats)), '9')
+
+            manager = Stats._managers['objects']
+            def fail(*args):
+                raise ConnectionError()
+            hashed.likes.incr(7)
+            stats.likes.incr(5)
+            try:
+                manager.execute_pipeline = fail
+                self.assertRaises(ConnectionError, counters.buffer.flush)
+                self.assertEqual(r.hget(HashedStats.key(str(hashed.id)), 'likes'), '7')
+                self.assertEqual(len(counters.buffer), 1)
+                counters.buffer.interval = 0
+                self.assertEqual(stats.likes.incr(), 15)
+                self.assertEqual(len(counters.buffer), 1)
+            finally:
+                del manager.execute_pipeline
+            counters.buffer.flush()
+            self.assertEqual(r.get(Stats.likes.key(stats)), '15')
+        finally:
+            counters.buffer = accumulator
+
+    def testDirtyFields(self):
+        team = "team%s" % random()
+        employee = Employee(name = "Dirty", team = team, level = 1)
+        employee.save()
+        loaded = Employee.get(employee.id)
+        calls = []
+        try:
+            instrumentation.enable(callback = lambda *args: calls.append(args))
+            loaded.save()
+            self.assertEqual(calls, [])
+            loaded.name = "Changed"
+            loaded.level = 2
+            loaded.save(update_fields = ['name'])
+            self.assertEqual([x[2] for x in calls], ['set'])
+            del calls[:]
+            loaded.save()
+            self.assertEqual(sorted(x[2] for x in calls), ['reindex', 'set'])
+        finally:
+            instrumentation.enable()
+        self.assertEqual((Employee.get(employee.id).name, Employee.get(employee.id).level), ("Changed", 2))
+        self.assertEqual(list(Employee.objects.filter(team = team, level = 2)), [employee])
+        loaded.team = None
+        loaded.save()
+        self.assertEqual(r.exists(Employee.team.key(employee)), False)
+        self.assertEqual(list(Employee.objects.filter(team = team)), [])
+        self.assertRaises(ImplementationError, loaded.save, update_fields = ['missing'])
+
+        new = Employee(name = "New", team = team, level = 3)
+        new.save(update_fields = ['name'])
+        self.assertEqual((Employee.get(new.id).name, Employee.get(new.id).level), ("New", 3))
+        self.assertEqual([x.id for x in Employee.objects.filter(team = team)], [new.id])
+
+        employee = Employee.get(employee.id)
+        employee.level = 0
+        employee.save()
+        self.assertEqual(Employee.get(employee.id).level, 0)
+        self.assertEqual([e.id for e in Employee.objects.filter(level = 0)], [employee.id])
+
+        doc = Document(data = {"a": 1})
+        doc.save()
+        doc.data["b"] = 2
+        doc.save()
+        self.assertEqual(Document.get(doc.id).data, {"a": 1, "b": 2})
+        loaded = Document.get(doc.id)
+        loaded.data["c"] = 3
+        loaded.save()
+        self.assertEqual(Document.get(doc.id).data, {"a": 1, "b": 2, "c": 3})
+
+    def testSlots(self):
+        point = Point(x = 1, y = 2)
+        self.assertEqual(hasattr(point, '__dict__'), False)
+        self.assertRaises(AttributeError, setattr, point, 'z', 3)
+        point.save()
+        point.tags.add("a")
+        loaded = Point.get_many([point.id], ['x', 'y', 'tags'])[0]
+        self.assertEqual((loaded.x, loaded.y, loaded.tags), (1, 2, set(["a"])))
+        self.assertEqual(loaded.get_queries()['count'], 0)
+        loaded = Point.get_many([point.id])[0]
+        self.assertEqual((loaded.x, loaded.y, loaded.is_fetched('tags')), (1, 2, False))
+        self.assertEqual(loaded.tags, set(["a"]))
+        self.assertEqual(loaded.get_queries()['count'], 1)
+        self.assertEqual(hasattr(User(), '__dict__'), True)
+
+        def size(obj):
+            containers = [obj._data, obj._fetched, obj._bound, obj._dirty, getattr(obj, '__dict__', None)]
+            return sys.getsizeof(obj) + sum(sys.getsizeof(x) for x in containers if x is not None)
+        plain = PlainPoint(x = 1, y = 2)
+        plain.save()
+        plain = PlainPoint.get_many([plain.id], ['x', 'y'])[0]
+        slotted = Point.get_many([point.id], ['x', 'y'])[0]
+        self.assertEqual(size(slotted) * 2 < size(plain), True)
+        self.assertEqual(Point._post_init_fields, [])
+        self.assertEqual(Reply._post_init_fields, [Reply.to])
+
+    def testSortedIndex(self):
+        group = "group%s" % random()
+        now = datetime.now().replace(microsecond = 0)
+        scores = [5, 1, 9, 3, 7]
+        posts = []
+        for i, score in enumerate(scores):
+            post = Post(group = group, score = score, created = now + timedelta(seconds = i))
+            post.save()
+            posts.append(post)
+        query = Post.objects.filter(group = group)
+        self.assertEqual([x.id for x in query.order_by('score')],
+                         [posts[i].id for i in (1, 3, 0, 4, 2)])
+        self.assertEqual([x.id for x in query.order_by('-created')[:2]],
+                         [posts[4].id, posts[3].id])
+        self.assertEqual([x.id for x in query.filter(score__gte = 3, score__lt = 9).order_by('score')],
+                         [posts[i].id for i in (3, 0, 4)])
+        self.assertEqual(set(query.filter(created__gt = now, score__lte = 5)), set([posts[1], posts[3]]))
+        self.assertEqual(query.order_by('-score')[1].score, 7)
+        self.assertEqual(Post.objects.order_by('score').filter(score__gt = 100).exists(), False)
+        posts[2].delete()
+        self.assertEqual(query.order_by('-score')[0].score, 7)
+        self.assertRaises(ImplementationError, Post.objects.filter, group__gt = 1)
+
+    def testQuerySet(self):
+        group = "group%s" % random()
+        posts = []
+        for score in range(1, 11):
+            post = Post(group = group, score = score)
+            post.save()
+            posts.append(post)
+        query = Post.objects.filter(group = group).batch(3)
+        self.assertEqual(query.count(), 10)
+        self.assertEqual(set(query), set(posts))
+        self.assertEqual(len(list(query[2:7])), 5)
+        self.assertEqual(query[2:].count(), 8)
+        self.assertEqual([x.score for x in query.order_by('score')[4:9]], range(5, 10))
+        self.assertEqual(query.filter(score__gte = 9).count(), 2)
+        self.assertEqual(query.filter(score__gt = 10).exists(), False)
+        post = list(query.only('score').order_by('-score')[:1])[0]
+        self.assertEqual(post._fetched, set(['score']))
+        self.assertEqual(post.score, 10)
+        self.assertEqual(post.get_queries()['count'], 0)
+        self.assertEqual(post.group, group)
+        self.assertEqual(Post.objects.all().count() >= 10, True)
+        self.assertEqual(len(set(Post.objects.all().batch(4).ids())), Post.objects.all().count())
+
+    def testInstrumentation(self):
+        calls = []
+        try:
+            instrumentation.disable()
+            note = NoteModel(note = self.message)
+            note.save()
+            self.assertEqual(note.get_queries()['count'], 0)
+            self.assertEqual(note._queries, None)
+
+            instrumentation.enable(size = 2)
+            note = NoteModel(note = self.message)
+            note.save()
+            queries = note.get_queries()
+            self.assertEqual(queries['count'], 5)
+            self.assertEqual(len(queries['queries']), 2)
+            stats = NoteModel.get_query_stats()
+            self.assertEqual(stats['commands']['incr']['count'] >= 1, True)
+            self.assertEqual(stats['commands']['set']['size'] >= len(self.message), True)
+
+            instrumentation.enable(callback = lambda *args: calls.append(args))
+            note.css = self.css
+            note.save()
+            self.assertEqual(calls[0][0], NoteModel)
+            self.assertEqual(calls[0][1], note)
+
+            instrumentation.enable(rate = 0)
+            note.css = self.css
+            note.save()
+            self.assertEqual(note.get_queries()['count'], 5)
+        finally:
+            instrumentation.enable()
+
+    def testObjectCache(self):
+        settings = [Setting(id = "setting%s" % random(), value = str(i)) for i in range(3)]
+        for x in settings:
+            x.save()
+        Setting._cache.clear()
+        first = Setting.get(settings[0].id)
+        again = Setting.get(settings[0].id)
+        self.assertEqual(again is first, False)
+        self.assertEqual(Setting.get_cache_stats()['hits'], 1)
+        first.value = "local"
+        self.assertEqual((again.value, again.is_dirty('value')), ("0", False))
+        many = Setting.get_many([x.id for x in settings] + ["missing"])
+        self.assertEqual(many, settings)
+        self.assertEqual(many[0].value, "0")
+        self.assertEqual(Setting.get_cache_stats()['hits'], 2)
+        self.assertEqual(Setting.get_cache_stats()['size'], 2)
+        Setting.get(settings[0].id)
+        self.assertEqual(Setting.get_cache_stats()['hits'], 2)
+
+        second = Setting.get(settings[1].id)
+        copy = Setting(id = settings[1].id, value = "changed")
+        copy.save()
+        self.assertEqual(Setting.get(settings[1].id).value, "changed")
+        self.assertEqual(second.value, "1")
+        copy.delete()
+        self.assertRaises(Setting.NotFound, Setting.get, settings[1].id)
+
+        shared = SharedSetting(id = "large%s" % random(), value = "1")
+        shared.save()
+        for i in range(100):
+            shared.tags.add(str(i))
+        SharedSetting.get_many([shared.id], ['value', 'tags'])
+        calls = []
+        try:
+            instrumentation.enable(callback = lambda *args: calls.append(args))
+            loaded = SharedSetting.get(shared.id)
+            self.assertEqual(loaded.value, "1")
+            self.assertEqual([x[2] for x in calls if x[2] in ('smembers', 'sscan')], [])
+            self.assertEqual(len(loaded.tags.value), 100)
+            self.assertEqual([x[2] for x in calls if x[2] == 'smembers'], ['smembers'])
+        finally:
+            instrumentation.enable()
+        self.assertEqual(SharedSetting._cache.get(SharedSetting.key(shared.id)).is_fetched('tags'), False)
+
+    def testCacheInvalidation(self):
+        connection = SharedSetting._connection
+        pubsub = connection.pubsub()
+        pubsub.subscribe(cache.CHANNEL)
+        setting = SharedSetting(id = "shared%s" % random(), value = "1")
+        setting.save()
+        setting.tags.add("x")
+        messages = [pubsub.get_message(timeout = 1) for i in range(3)]
+        key = SharedSetting.key(setting.id)
+        self.assertEqual([x['data'] for x in messages[1:]], [cache.message(key)] * 2)
+        pubsub.close()
+
+        SharedSetting.get(setting.id)
+        cache.handle_message(cache.message(key))
+        self.assertEqual(SharedSetting._cache.get(key) is None, False)
+
+        listener = cache.start_listener(connection)
+        try:
+            for i in range(100):
+                connection.publish(cache.CHANNEL, "other %s" % key)
+                if SharedSetting._cache.get(key) is None:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(SharedSetting._cache.get(key), None)
+        finally:
+            listener.stop()
+            listener.join()
+
+        # invalidation received while instance is loaded
+        SharedSetting._cache.clear()
+        load_many = SharedSetting.load_many
+        def racing(objects, fields = None, check = False):
+            found = load_many(objects, fields, check)
+            cache.handle_message("other %s" % key)
+            return found
+        try:
+            SharedSetting.load_many = staticmethod(racing)
+            self.assertEqual(SharedSetting.get(setting.id).value, "1")
+        finally:
+            del SharedSetting.load_many
+        self.assertEqual(SharedSetting._cache.get(key), None)
+        SharedSetting.get(setting.id)
+        self.assertEqual(SharedSetting._cache.get(key) is None, False)
+
     def testProfile(self):
         twitter = "http:// twitter.com/Lispython"
         profile = UserProfile(
@@ -189,6 +799,56 @@ class OredisTestCase(unittest.TestCase):
         self.assertEqual(user.likes.lpop(), "dzone")
         
 
+    def testIncrementalMutation(self):
+        user = User(name = "Incremental")
+        user.save()
+        user.likes.append("a")
+        self.assertEqual(user.likes, ["a"])
+        count = user.get_queries()['count']
+        for x in ("b", "c", "b"):
+            user.likes.append(x)
+        user.likes.prepend("z")
+        self.assertEqual(user.likes, ["z", "a", "b", "c", "b"])
+        user.likes.lrem("b")
+        user.likes[0] = "y"
+        self.assertEqual(user.likes.rpop(), "c")
+        user.likes.trim(0, 0)
+        self.assertEqual(user.likes, ["y"])
+        user.tags.add("x")
+        user.tags.add("y")
+        user.tags.rem("x")
+        self.assertEqual(user.tags, set(["y"]))
+        # one command per mutation and one load for tags
+        self.assertEqual(user.get_queries()['count'] - count, 12)
+
+        self.assertEqual(user.likes is user.likes, True)
+        self.assertEqual(user.likes.handler, User.likes.handler)
+        self.assertEqual((user.likes.default, user.likes.serializer), (User.likes.default, User.likes.serializer))
+
+        r.rpush(User.likes.key(user), "external")
+        self.assertEqual(user.likes, ["y"])
+        user.likes.append("w")
+        self.assertEqual(user.likes, ["y", "external", "w"])
+        r.rpush(User.likes.key(user), "again")
+        self.assertEqual(user.likes.refresh(), ["y", "external", "w", "again"])
+
+    def testScan(self):
+        user = User(name = "Scan")
+        user.save()
+        for i in range(7):
+            user.likes.append("l%d" % i)
+            user.tags.add("t%d" % i)
+        user.likes.lrem("l6")
+        self.assertEqual(list(user.likes.iter_chunks(3)), [["l0", "l1", "l2"], ["l3", "l4", "l5"]])
+        self.assertEqual(list(user.likes.scan(4)), ["l%d" % i for i in range(6)])
+        self.assertEqual(set(user.tags.scan(2)), set("t%d" % i for i in range(7)))
+        h = HashModel(name = "scan")
+        h.save()
+        for i in range(5):
+            h.data["k%d" % i] = str(i)
+        self.assertEqual(dict(h.data.scan(2)), dict(("k%d" % i, str(i)) for i in range(5)))
+        self.assertEqual(list(User(name = "Empty").likes.scan()), [])
+
     def testComposite(self):
         tags =  set(['django', 'python', 'ruby', 'erlang'])
         super_tags =  set(['python',   'hsakel', 'erlang', 'django'])
@@ -233,6 +893,97 @@ class OredisTestCase(unittest.TestCase):
         user2 = Author.get(user.id)
         self.assertEqual(user2, user)
         self.assertEqual([ x for x in user2.tags], [x for x in user.tags])
+
+    def testLinkLoading(self):
+        tags = [TagModel(id = "link%d%s" % (i, random()), counter = i + 1) for i in range(20)]
+        author, reader = Author(name = "links%s" % random()), Reader()
+        author.save()
+        reader.save()
+        for tag in tags:
+            tag.save()
+            author.tags.add(tag)
+            reader.tags.add(tag)
+        r.srem(TagModel.id.key(), tags[0].id)
+        calls = []
+        try:
+            instrumentation.enable(callback = lambda *args: calls.append(args))
+            loaded = Author.get(author.id)
+            linked = loaded.tags.value
+            self.assertEqual(linked, set(tags[1:]))
+            self.assertEqual(len([x for x in calls if x[2] == 'sismember']), 20)
+            self.assertEqual(set(x.counter for x in linked), set(range(2, 21)))
+            self.assertEqual(len([x for x in calls if x[2] == 'get']), 20)
+            del calls[:]
+            self.assertEqual(loaded.tags.value, linked)
+            self.assertEqual(tags[1] in loaded.tags.value, True)
+            self.assertEqual(calls, [])
+            loaded.tags.invalidate()
+            self.assertEqual(loaded.tags.value, linked)
+            self.assertEqual(len([x for x in calls if x[2] == 'sismember']), 20)
+            del calls[:]
+            stubs = Reader.get(reader.id).tags.value
+            self.assertEqual(len(stubs), 20)
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(set(x.counter for x in stubs if x.id != tags[0].id), set(range(2, 21)))
+        finally:
+            instrumentation.enable()
+
+    def testRelated(self):
+        team = "team%s" % random()
+        bosses = [User(name = "Boss%d" % i) for i in range(3)]
+        for boss in bosses:
+            boss.save()
+        Employee.objects.bulk_create([Employee(name = "E%d" % i, team = team, boss = bosses[i % 3])
+                                      for i in range(9)])
+        calls = []
+        try:
+            instrumentation.enable(callback = lambda *args: calls.append(args))
+            employees = list(Employee.objects.filter(team = team).select_related('boss').only('name'))
+            count = len(calls)
+            self.assertEqual(sorted(x.boss.name for x in employees), sorted(["Boss0", "Boss1", "Boss2"] * 3))
+            self.assertEqual(len(calls), count)
+            self.assertEqual(len([x for x in calls if x[0] is User and x[2] == 'sismember']), 3)
+        finally:
+            instrumentation.enable()
+
+        tags = [TagModel(id = "prefetch%d%s" % (i, random())) for i in range(3)]
+        authors = [Reader() for i in range(2)]
+        for tag in tags:
+            tag.save()
+        for i, author in enumerate(authors):
+            author.save()
+            for tag in tags[i:]:
+                author.tags.add(tag)
+        loaded = dict((x.id, x) for x in Reader.objects.all().prefetch_related('tags'))
+        first, second = loaded[authors[0].id], loaded[authors[1].id]
+        count = TagModel.get_query_stats()['count']
+        self.assertEqual(first.tags.value, set(tags))
+        self.assertEqual(second.tags.value, set(tags[1:]))
+        self.assertEqual(TagModel.get_query_stats()['count'], count)
+        first.tags.rem(tags[0])
+        self.assertEqual(first.tags.value, set(tags[1:]))
+        self.assertRaises(ImplementationError, Reader.objects.all().select_related, 'tags')
+
+    def testSetAlgebra(self):
+        tags = [TagModel(id = "algebra%d%s" % (i, random())) for i in range(4)]
+        for tag in tags:
+            tag.save()
+        first, second = Author(name = "first%s" % random()), Author(name = "second%s" % random())
+        first.save()
+        second.save()
+        for tag in tags[:3]:
+            first.tags.add(tag)
+        for tag in tags[1:]:
+            second.tags.add(tag)
+        self.assertEqual(set(first.tags.inter_objects(second.tags)), set(tags[1:3]))
+        self.assertEqual(len(first.tags.union_objects(second.tags)), 4)
+        self.assertEqual(first.tags.diff_objects(second.tags), [tags[0]])
+        self.assertEqual(first.tags.intercard(second.tags), 2)
+        self.assertEqual(first.tags.intercard(second.tags, limit = 1), 1)
+        key = first.tags.unionstore(second.tags, ttl = 60)
+        self.assertEqual(0 < r.ttl(key) <= 60, True)
+        self.assertEqual(set(x for chunk in first.tags.iter_chunks(2, key = key) for x in chunk), set(tags))
+        self.assertEqual(len(first.tags.inter(second.tags, TagModel.id.key())), 2)
         
 
     def testHash(self):
@@ -275,6 +1026,31 @@ class ManagerTestCase(unittest.TestCase):
             body = "I love the world!"
             )
 
+    def testConnections(self):
+        self.assertEqual(User._connection is NoteModel._connection, True)
+        self.assertEqual(User._connection is get_connection(), True)
+        self.assertEqual(Article.amanager.connection is r, True)
+        self.assertRaises(ImplementationError, lambda: CachedNote._connection)
+        cache = Redis()
+        configure(cache = cache)
+        self.assertEqual(CachedNote.objects.using, 'cache')
+        self.assertEqual(CachedNote._connection is cache, True)
+        note = CachedNote(text = "cached")
+        note.save()
+        self.assertEqual(CachedNote.get(note.id).text, "cached")
+
+    def testDecoding(self):
+        self.article.save()
+        article = Article.get(self.article.id)
+        self.assertEqual(article.title, u"My first article")
+        self.assertEqual(type(article.title), unicode)
+        self.assertEqual(Article.amanager.decoder is Article.amanager.decoder, True)
+        configure(latin = {'encoding': 'latin-1'}, broken = {'encoding_errors': 'replace'})
+        self.assertEqual(get_decoder('latin')("\xe9"), u"\xe9")
+        self.assertEqual(get_decoder('broken')("\xff"), u"\ufffd")
+        self.assertRaises(UnicodeDecodeError, get_decoder(), "\xff")
+        self.assertEqual(get_decoder() is get_decoder(), True)
+
     def testManager(self):
         self.assertEqual(Article.amanager.connection.ping(), True)
         self.assertEqual(Article.amanager.some_method(), "Some method work for model %s with name %s" % (Article, Article.amanager._name))